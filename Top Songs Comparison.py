@@ -25,15 +25,18 @@
 #%pip install time
 #%pip install seaborn
 #%pip install matplotlib
+#%pip install pyarrow
+#%pip install neo4j
 
 #setup pyspark and neo4j Spark init
 import pyspark
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import translate, split, col, expr, regexp_replace, lit,  round, monotonically_increasing_id, udf
+from pyspark.sql.functions import translate, split, col, expr, regexp_replace, lit,  round, monotonically_increasing_id, udf, explode, count
 #from pyspark.sql.types import StringType, FloatType
 from pyspark.sql.types import *
 # NEO4J  CONFIGURATION
 bolt_url = "bolt://neo4j:7687"
+neo4j_auth = None  # (user, password) if the database requires authentication
 # Spark init
 spark = SparkSession.builder \
     .master("local") \
@@ -56,6 +59,10 @@ import time
 from time import sleep
 import seaborn as sns
 import matplotlib.pyplot as plt
+import ast
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
 
 # Credentials
 # API dependencies
@@ -67,7 +74,10 @@ from spotipy.oauth2 import SpotifyClientCredentials
 #cid = <your credentials here>
 #secret = <your credentials here>
 ccm = SpotifyClientCredentials(client_id = cid, client_secret = secret)
-sp = spotipy.Spotify(client_credentials_manager = ccm)
+# Pass a plain requests session so that 429 responses come back to us (with their Retry-After header)
+# instead of being retried inside spotipy, the rate limiter below handles retries for every call
+import requests
+sp = spotipy.Spotify(client_credentials_manager = ccm, requests_session = requests.Session())
 print("Dependencies imported and spotipy functions enabled")
 
 ###This creates a "default_directory" variable, where the directory path to the
@@ -78,6 +88,213 @@ print("Dependencies imported and spotipy functions enabled")
 # would be inserted between the quotes below.
 default_directory = "<DEFAULT DIRECTORY PATH HERE>"
 
+import sqlite3
+import random
+import threading
+
+###Token bucket rate limiter shared by every Spotify call. Requests go out as
+# fast as the configured requests per second allows (with short bursts up to
+# the bucket size), instead of pausing for a fixed 90 seconds after every country.
+# When Spotify answers with HTTP 429 the limiter waits for the Retry-After time
+# (or an exponential backoff with jitter on server errors, dropped connections
+# and timeouts) before trying again, and holds back every other request during
+# that wait as well.
+spotify_requests_per_second = 5
+
+class RateLimiter:
+    def __init__(self, requests_per_second=spotify_requests_per_second, burst=10, max_retries=5, backoff=2.0, jitter=1.0):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.jitter = jitter
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    # Wait until a token is available, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.requests_per_second)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.requests_per_second)
+            sleep(wait)
+
+    # Stop all requests for the given number of seconds
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def call(self, method, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                return method(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                if (e.http_status != 429 and e.http_status < 500) or attempt == self.max_retries:
+                    raise
+                self.throttled += 1
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+                wait = float(retry_after) if retry_after else self.backoff * 2 ** attempt
+                wait += random.uniform(0, self.jitter)
+                print(f"Spotify returned {e.http_status}, retrying in {wait:.1f} seconds...")
+                self.pause(wait)
+            # spotipy's own retries are off with the plain session, so dropped connections and timeouts are retried here
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.throttled += 1
+                wait = self.backoff * 2 ** attempt + random.uniform(0, self.jitter)
+                print(f"Request failed ({type(e).__name__}), retrying in {wait:.1f} seconds...")
+                self.pause(wait)
+
+rate_limiter = RateLimiter()
+
+###Wrap the spotipy client in an on-disk cache so that re-running the collection
+# (after a crash or for a few new countries) only hits the API for data that is
+# actually new. Responses are stored in a SQLite file keyed by endpoint and
+# parameters, each endpoint has its own time to live, and the least recently
+# used responses are evicted once the cache grows past its size cap.
+# How long (in seconds) a cached response stays valid for each endpoint, anything not listed uses 'default'
+cache_ttls = {
+    'featured_playlists': 24 * 60 * 60,
+    'playlist_tracks': 24 * 60 * 60,
+    'next': 24 * 60 * 60,
+    'artists': 7 * 24 * 60 * 60,
+    'artist': 7 * 24 * 60 * 60,
+    'track': 30 * 24 * 60 * 60,
+    'audio_features': 30 * 24 * 60 * 60,
+    'default': 24 * 60 * 60
+}
+
+class CachedSpotify:
+    # Batch endpoints are cached with one entry per id instead of one per batch, so an id that was fetched as part of
+    # any earlier batch is never fetched again. Each entry is (split the response into one result per id, put the
+    # results back together into the shape the endpoint returns).
+    batch_endpoints = {
+        'audio_features': (lambda response: response or [], lambda results: results),
+        'artists': (lambda response: response['artists'], lambda results: {'artists': results})
+    }
+
+    def __init__(self, client, db_path, ttls=cache_ttls, max_bytes=512 * 1024 * 1024, limiter=rate_limiter):
+        self.client = client
+        self.limiter = limiter
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # The connection is shared by the collection worker threads, so every database access holds this lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses
+                           (key TEXT PRIMARY KEY, endpoint TEXT, response TEXT, size INTEGER, created REAL, last_access REAL)""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    # Any spotipy endpoint called on the wrapper (sp.artists, sp.audio_features, etc.) goes through the cache
+    def __getattr__(self, endpoint):
+        method = getattr(self.client, endpoint)
+        if not callable(method):
+            return method
+
+        def cached_call(*args, **kwargs):
+            if endpoint in self.batch_endpoints and len(args) == 1:
+                return self.call_batch(endpoint, method, args[0], **kwargs)
+            return self.call(endpoint, method, *args, **kwargs)
+        return cached_call
+
+    def make_key(self, endpoint, args, kwargs):
+        # sp.next is called with the whole previous page, the url of the next page is all that identifies it
+        if endpoint == 'next' and args and isinstance(args[0], dict):
+            return f"next:{args[0].get('next')}"
+        return f"{endpoint}:{json.dumps([args, kwargs], sort_keys=True, default=str)}"
+
+    # Returns {key: response} for the keys that are cached and still within the endpoint's time to live
+    def lookup(self, endpoint, keys, now):
+        ttl = self.ttls.get(endpoint, self.ttls['default'])
+        found = {}
+        with self.lock:
+            for key in keys:
+                row = self.db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row and now - row[1] <= ttl:
+                    found[key] = json.loads(row[0])
+                    self.db.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            self.db.commit()
+        return found
+
+    def call(self, endpoint, method, *args, **kwargs):
+        key = self.make_key(endpoint, args, kwargs)
+        now = time.time()
+        found = self.lookup(endpoint, [key], now)
+        if key in found:
+            return found[key]
+
+        # The request itself is made outside the lock so other threads can keep using the cache
+        response = self.limiter.call(method, *args, **kwargs)
+        self.store({key: response}, endpoint, now)
+        return response
+
+    # Look up each id of a batch on its own, request only the ids that aren't cached and return the results in order
+    def call_batch(self, endpoint, method, ids, **kwargs):
+        split, combine = self.batch_endpoints[endpoint]
+        ids = list(ids)
+        keys = [self.make_key(endpoint, [idd], kwargs) for idd in ids]
+        now = time.time()
+        found = self.lookup(endpoint, list(dict.fromkeys(keys)), now)
+
+        missing = list(dict.fromkeys(idd for idd, key in zip(ids, keys) if key not in found))
+        if missing:
+            response = self.limiter.call(method, missing, **kwargs)
+            fetched = {self.make_key(endpoint, [idd], kwargs): result for idd, result in zip(missing, split(response))}
+            self.store(fetched, endpoint, now)
+            found.update(fetched)
+        return combine([found.get(key) for key in keys])
+
+    # Save {key: response} entries, then evict if the cache has grown past its size cap
+    def store(self, responses, endpoint, now):
+        with self.lock:
+            for key, response in responses.items():
+                payload = json.dumps(response)
+                old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                if old:
+                    self.size -= old[0]
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, endpoint, payload, len(payload), now, now))
+                self.size += len(payload)
+            self.evict()
+            self.db.commit()
+
+    # Drop the least recently used responses until the cache is back under its size cap
+    def evict(self):
+        while self.size > self.max_bytes:
+            rows = self.db.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+    def cache_stats(self):
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self.size}
+
+sp = CachedSpotify(sp, f'{default_directory}/datafiles/spotify_cache.sqlite')
+print("spotipy response cache enabled")
+
 #import the world_top_playlists data that will be used later for analysis
 world_top_playlists = pd.read_csv(f'{default_directory}/datafiles/world_top_playlists.csv')
 
@@ -96,47 +313,48 @@ world_top_playlists = pd.read_csv(f'{default_directory}/datafiles/world_top_play
 ### *GitHub: github.com/victoryamaykin*
 ################################################################################
 
-# Function to get the top Spotify playlist for each country
-def get_top_playlists(country_codes):
-    country_names = []
+# Number of featured playlists collected for each country, raise it to collect more than the top playlist per market
+top_playlists_per_country = 1
 
-    for i,t in enumerate(countries):
-        for c in country_codes:
-            if c in t:
-                if len(sorted(t)[1])==2:
-                    country_names.insert(list(country_codes).index(c), sorted(t)[0])
-                else:
-                    country_names.insert(list(country_codes).index(c), sorted(t)[1])
-    pl_names = []
-    pl_ids = []
+# Only the parts of the playlist items that get_spotify_dataframes uses (plus 'next' for paging)
+playlist_track_fields = 'items(track(id,name,popularity,explicit,artists(id,name),album(id,name))),next'
 
-    for c in country_codes:
-        response = sp.featured_playlists(country = c)
+# Function to get the top n featured Spotify playlists for each country
+# Returns {country code: {'country_name', 'playlists': [{'pl_name', 'pl_id'}, ...], 'pl_name', 'pl_id'}}, with pl_name
+# and pl_id being the country's first playlist. Only as many pages as needed for n playlists are requested.
+# n defaults to top_playlists_per_country at the time of the call.
+def get_top_playlists(country_codes, n=None, page_size=50):
+    if n is None:
+        n = top_playlists_per_country
+    country_names = country_registry.names_for(country_codes)
+    top_pl = {}
+
+    for c, country_name in zip(country_codes, country_names):
+        pl_list = []
+        response = sp.featured_playlists(country = c, limit = min(n, page_size))
 
         while response:
             playlists = response['playlists']
-            for i, item in enumerate(playlists['items']):
-                pl_names.append(item['name'])
-                pl_ids.append(item['id'])
+            for item in playlists['items']:
+                if item:
+                    pl_list.append({'pl_name': item['name'], 'pl_id': item['id']})
 
-            if playlists['next']:
+            if len(pl_list) < n and playlists['next']:
                 response = sp.next(playlists)
             else:
                 response = None
 
-    keys = ['country_name','pl_name','pl_id']
-    top_pl = {}
-
-    for i in range(len(country_codes)):
-        sub_dict = {keys[0]: country_names[i], keys[1]: pl_names[i], keys[2]: pl_ids[i]}
-        top_pl[country_codes[i]] = sub_dict
+        pl_list = pl_list[:n]
+        top_pl[c] = {'country_name': country_name, 'playlists': pl_list,
+                     'pl_name': pl_list[0]['pl_name'] if pl_list else None,
+                     'pl_id': pl_list[0]['pl_id'] if pl_list else None}
 
     return top_pl
 print("get_top_playlists function created")
 
 # Function to extract tracks from a playlist thats longer than 100 songs
-def get_playlist_tracks(playlist_id):
-    results = sp.playlist_tracks(playlist_id)
+def get_playlist_tracks(playlist_id, fields=playlist_track_fields):
+    results = sp.playlist_tracks(playlist_id, fields = fields)
     tracks = results['items']
     while results['next']:
         results = sp.next(results)
@@ -144,705 +362,759 @@ def get_playlist_tracks(playlist_id):
     return tracks
 print("get_playlist_tracks function created")
 
+# The audio features collected for every track
+feature_list = ['key', 'tempo', 'time_signature', 'valence', 'liveness', 'energy', 'danceability', 'loudness',
+                'speechiness', 'acousticness', 'instrumentalness', 'mode', 'duration_ms']
+
+# Spotify returns these features as whole numbers, the rest are floats
+integer_features = ['key', 'time_signature', 'mode', 'duration_ms']
+
+audio_features_schema = StructType([StructField('track_id', StringType())] +
+                                   [StructField(f, LongType() if f in integer_features else DoubleType()) for f in feature_list])
+
+# The columns (and their Spark types) of the collected dataset, in order
+track_columns = ['artist', 'artist_id', 'album', 'album_id', 'track_name', 'track_id', 'genre', 'popularity', 'explicit']
+collection_columns = track_columns + feature_list + ['norm_tempo', 'playlist_id', 'top_playlist_name', 'country_code', 'country']
+collection_schema = StructType([
+    StructField('artist', StringType()),
+    StructField('artist_id', StringType()),
+    StructField('album', StringType()),
+    StructField('album_id', StringType()),
+    StructField('track_name', StringType()),
+    StructField('track_id', StringType()),
+    StructField('genre', ArrayType(StringType())),
+    StructField('popularity', LongType()),
+    StructField('explicit', BooleanType())] +
+    audio_features_schema.fields[1:] + [
+    StructField('norm_tempo', DoubleType()),
+    StructField('playlist_id', StringType()),
+    StructField('top_playlist_name', StringType()),
+    StructField('country_code', StringType()),
+    StructField('country', StringType())])
+
+# The same columns as a Parquet (Arrow) schema. country_code isn't stored in the files,
+# it is the partition directory name (country_code=US) so Spark and pandas add it back when reading.
+collection_arrow_schema = pa.schema(
+    [pa.field(c, pa.string()) for c in ['artist', 'artist_id', 'album', 'album_id', 'track_name', 'track_id']] +
+    [pa.field('genre', pa.list_(pa.string())), pa.field('popularity', pa.int64()), pa.field('explicit', pa.bool_())] +
+    [pa.field(f, pa.int64() if f in integer_features else pa.float64()) for f in feature_list] +
+    [pa.field('norm_tempo', pa.float64()), pa.field('playlist_id', pa.string()),
+     pa.field('top_playlist_name', pa.string()), pa.field('country', pa.string())])
+
+# Convert a raw feature value to the type used in audio_features_schema (Spotify sometimes sends 0 instead of 0.0)
+def typed_feature(feature, value):
+    if value is None:
+        return None
+    return int(value) if feature in integer_features else float(value)
+
+# Running totals for the batched audio features lookups so the savings can be reported for a whole collection run
+audio_feature_stats = {'tracks': 0, 'calls': 0, 'calls_saved': 0}
+stats_lock = threading.Lock()
+
+# Function to look up the audio features for a list of track ids, sending up to 100 ids per API call
+def get_audio_features(track_ids, batch_size=100):
+    audio_features = {}
+    unique_ids = list(dict.fromkeys(idd for idd in track_ids if idd))
+    calls = 0
+
+    for start in range(0, len(unique_ids), batch_size):
+        batch = unique_ids[start:start + batch_size]
+        try:
+            results = sp.audio_features(batch)
+            calls += 1
+        except Exception as e:
+            print(
+                f"Error occurred while retrieving audio features for {len(batch)} track ids. Error message: {str(e)}")
+            continue
+        for idd, features in zip(batch, results or []):
+            if features:
+                audio_features[idd] = features
+
+    # Previously every track cost one call to check it had features and a second call to collect them
+    old_calls = len(track_ids) + sum(1 for idd in track_ids if idd in audio_features)
+    with stats_lock:
+        audio_feature_stats['tracks'] += len(track_ids)
+        audio_feature_stats['calls'] += calls
+        audio_feature_stats['calls_saved'] += old_calls - calls
+    print(f"Retrieved audio features for {len(audio_features)} tracks in {calls} API calls ({old_calls - calls} calls saved)")
+    return audio_features
+print("get_audio_features function created")
+
+# Genres for every artist seen so far in the run, so each distinct artist is only looked up once across all countries
+artist_genres = {}
+
+# Function to look up the genres for a list of artist ids, sending up to 50 ids per API call and skipping artists already resolved
+def resolve_artist_genres(artist_ids, batch_size=50):
+    new_ids = list(dict.fromkeys(idd for idd in artist_ids if idd and idd not in artist_genres))
+
+    for start in range(0, len(new_ids), batch_size):
+        batch = new_ids[start:start + batch_size]
+        try:
+            results = sp.artists(batch)['artists']
+        except Exception as e:
+            print(
+                f"Error occurred while retrieving genres for {len(batch)} artist ids. Error message: {str(e)}")
+            continue
+        for idd, artist in zip(batch, results):
+            if artist:
+                artist_genres[idd] = artist['genres']
+
+    return {idd: artist_genres.get(idd, []) for idd in artist_ids}
+print("resolve_artist_genres function created")
+
 # Function to take all of the tracks from a playlist, collect the attributes for each track, then combine it into a dataframe.
+# The dataframe is a plain pandas dataframe, the Spark dataframe is only created once at the end of the whole collection.
 def get_spotify_dataframes(playlist_name, playlist_id):
-    # Set up empty lists for the relevant data
-    artist_name, artist_id, album, album_id, track_name, track_ids, genre, popularity, explicit = [
-    ], [], [], [], [], [], [], [], []
+    # Set up an empty list to hold one record per track
+    records = []
 
     # Use the get_playlist_tracks function to retrieve the track results
     track_results = get_playlist_tracks(playlist_id)
 
+    # Look up the audio features for the whole playlist at once, the same map is used to skip tracks without features and to fill the feature columns
+    audio_features = get_audio_features([t['track']['id'] for t in track_results if t['track']])
+
+    # Resolve the genres for all of the playlist's artists in bulk instead of one lookup per track
+    resolve_artist_genres([t['track']['artists'][0]['id'] for t in track_results
+                           if t['track'] and t['track']['artists'] and audio_features.get(t['track']['id'])])
+
     for t in track_results:
         if t['track']:
-            if sp.audio_features(t['track']['id'])[0]:
+            if audio_features.get(t['track']['id']):
                 try:
-                    artist = t['track']['artists'][0]['name']
-                    artist_name.append(artist)
-                    artist_id.append(t['track']['artists'][0]['id'])
-                    album.append(t['track']['album']['name'])
-                    album_id.append(t['track']['album']['id'])
-                    track_name.append(t['track']['name'])
-                    track_ids.append(t['track']['id'])
-                    genre.append(sp.artist(t['track']['artists'][0]['id'])['genres'])
-                    popularity.append(t['track']['popularity'])
-                    explicit.append(sp.track(t['track']['id'])['explicit'])
+                    records.append({
+                        'artist': t['track']['artists'][0]['name'],
+                        'artist_id': t['track']['artists'][0]['id'],
+                        'album': t['track']['album']['name'],
+                        'album_id': t['track']['album']['id'],
+                        'track_name': t['track']['name'],
+                        'track_id': t['track']['id'],
+                        'genre': artist_genres.get(t['track']['artists'][0]['id'], []),
+                        'popularity': t['track']['popularity'],
+                        # The explicit flag is already part of the playlist item, so the track doesn't need to be looked up again
+                        'explicit': t['track']['explicit']
+                    })
                 except Exception as e:
                     print(
                         f"Error occurred while processing track: {t}. Error message: {str(e)}")
-                    artist_name.append("")
-                    artist_id.append("")
-                    album.append("")
-                    album_id.append("")
-                    track_name.append("")
-                    track_ids.append("")
-                    genre.append("")
-                    popularity.append("")
-                    explicit.append("")
             else:
                 next
 
-    # Create a DataFrame with the basic song information and popularity
-    tracks_df = spark.createDataFrame(zip(artist_name, artist_id, album, album_id, track_name, track_ids, genre, popularity, explicit),
-                                      schema=['artist', 'artist_id', 'album', 'album_id', 'track_name', 'track_id', 'genre', 'popularity', 'explicit'])
-
-    # Set up empty dictionary to hold the audio features
-    audio_features = {}
-
-    # Put all the ids in a list for the spotipy object to look up the audio features
-    for idd in track_ids:
-        try:
-            audio_features[idd] = sp.audio_features(idd)[0]
-        except Exception as e:
-            print(
-                f"Error occurred while retrieving audio features for track id: {idd}. Error message: {str(e)}")
+    if len(records) == 0:
+        return None
 
-    feature_list = ['key', 'tempo', 'time_signature', 'valence', 'liveness', 'energy', 'danceability', 'loudness',
-                    'speechiness', 'acousticness', 'instrumentalness', 'mode', 'duration_ms']
+    # Create a DataFrame with the basic song information and popularity
+    tracks_df = pd.DataFrame.from_records(records, columns=track_columns)
 
-    # Define a UDF to apply the lambda function
-    extract_feature_udf = udf(
-        lambda idd, feature: audio_features[idd][feature])
+    # Build the audio features as their own typed dataframe and join them onto the tracks in one step
+    features_df = pd.DataFrame.from_records(
+        [tuple([idd] + [typed_feature(f, audio_features[idd].get(f)) for f in feature_list])
+         for idd in tracks_df['track_id'].unique()],
+        columns=['track_id'] + feature_list)
+    tracks_df = tracks_df.merge(features_df, on='track_id', how='left')
 
-    # Add each audio feature to the tracks DataFrame
-    for feature in feature_list:
-        try:
-            tracks_df = tracks_df.withColumn(
-                feature, extract_feature_udf(col('track_id'), lit(feature)))
-        except Exception as e:
-            print(
-                f"Error occurred while adding audio feature '{feature}' to DataFrame. Error message: {str(e)}")
+    # Sort by popularity and add the playlist columns
+    tracks_df = tracks_df.sort_values('popularity', ascending=False, kind='stable')
+    tracks_df['playlist_id'] = playlist_id
+    tracks_df['top_playlist_name'] = playlist_name
+    return tracks_df
 
-    try:
-        # Define column to normalize
-        min_tempo_row = tracks_df.select(
-            'tempo').agg({'tempo': 'min'}).collect()
 
-        if min_tempo_row and min_tempo_row[0] and min_tempo_row[0][0] is not None:
-            x = min_tempo_row[0][0]
+print("get_spotify_dataframes function created")
 
-            # Normalize the tempo variable
-            tracks_df = tracks_df.withColumn(
-                'norm_tempo', (tracks_df['tempo'] - x) / x)
+#I utilized these next code chunks to test playlists from two different countries to ensure the function worked
+#test = get_spotify_dataframes('State of Mind', '37i9dQZF1DX1YPTAhwehsC')
+#test.info()
 
-            # Sort by popularity
-            sorted_df = tracks_df.orderBy(col('popularity').desc())
+#test2 = get_spotify_dataframes('late night vibes', '37i9dQZF1DXdQvOLqzNHSW')
+#test2.info()
+
+# Function to normalize the tempo of every track against the slowest track in the same playlist, for all playlists in one vectorized pass.
+# Playlists where no track has a tempo are dropped, the same as before.
+def add_norm_tempo(df):
+    min_tempo = df['tempo'].astype('float64').groupby(df['playlist_id']).transform('min')
+    df = df[min_tempo.notna()].copy()
+    min_tempo = min_tempo[min_tempo.notna()]
+    df['norm_tempo'] = (df['tempo'].astype('float64') - min_tempo) / min_tempo
+    return df
+print("add_norm_tempo function created")
+
+# Function to give the collected columns their final types
+def set_collection_types(df):
+    df = df.copy()
+    for f in feature_list:
+        df[f] = df[f].astype('Int64' if f in integer_features else 'float64')
+    df['norm_tempo'] = df['norm_tempo'].astype('float64')
+    df['popularity'] = df['popularity'].astype('Int64')
+    df['explicit'] = df['explicit'].astype('boolean')
+    return df[collection_columns]
+
+# Function to turn the collected pandas dataframe into a Spark dataframe with collection_schema.
+# Missing values are converted to None so Spark stores them as nulls.
+def to_spark_dataframe(df):
+    df = set_collection_types(df)
+    records = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    return spark.createDataFrame(list(records), schema=collection_schema)
+print("to_spark_dataframe function created")
+
+#create the function that will collect the playlist of top songs for a single country
+def make_country_dataset(country_code, n=None):
+    top_pl = get_top_playlists([country_code], n)
+    dfs = []
 
-            # Add additional columns
-            sorted_df = sorted_df.withColumn('playlist_id', lit(playlist_id))
-            sorted_df = sorted_df.withColumn(
-                'top_playlist_name', lit(playlist_name))
+    for k, v in top_pl.items():
+        for pl in v['playlists']:
+            print(f"Making dataframe for {k}: {v['country_name']} ({pl['pl_name']})")
+            new_df = get_spotify_dataframes(pl['pl_name'], pl['pl_id'])
+            if new_df is not None:  # Check if new_df is not None
+                new_df['country_code'] = k
+                new_df['country'] = v['country_name']
+                dfs.append(new_df)
 
-            return sorted_df
-        else:
-            return None
-    except Exception as e:
-        print(
-            f"Error occurred while normalizing tempo column. Error message: {str(e)}")
+    if len(dfs) == 0:
         return None
+    return add_norm_tempo(pd.concat(dfs, ignore_index=True))
+print("make_country_dataset function created")
 
+# Number of countries collected at the same time, every worker still shares the same rate limiter and response cache
+collection_workers = 4
 
-print("get_spotify_dataframes function created")
-
-#I utilized these next code chunks to test playlists from two different countries to ensure the function worked
-#test = get_spotify_dataframes('State of Mind', '37i9dQZF1DX1YPTAhwehsC')
-#test.printSchema()
-
-#test2 = get_spotify_dataframes('late night vibes', '37i9dQZF1DXdQvOLqzNHSW')
-#test2.printSchema()
+from concurrent.futures import ThreadPoolExecutor
 
 #create the function that will collect the playlist of top songs from each country that has Spotify
-def make_sp_dataset(country_codes):
-    top_pl = get_top_playlists(country_codes)
+#countries are collected in parallel by a bounded pool of worker threads, the results are merged in the same order as country_codes
+#the rows are kept in pandas until every country is done and a single Spark dataframe is created at the end (as_spark=False returns the pandas dataframe)
+# n is the number of featured playlists collected per country (top_playlists_per_country when not given)
+def make_sp_dataset(country_codes, max_workers=collection_workers, as_spark=True, n=None):
     dfs = []
 
-    for k, v in top_pl.items():
-        print(f"Making dataframe for {k}: {v['country_name']}")
-        new_df = get_spotify_dataframes(v['pl_name'], v['pl_id'])
-        if new_df is not None:  # Check if new_df is not None
-            new_df = new_df.withColumn('country_code', lit(k))
-            new_df = new_df.withColumn('country', lit(v['country_name']))
-            dfs.append(new_df)
-        print('Pausing for 90 seconds...')
-        time.sleep(90)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for country_df in executor.map(lambda c: make_country_dataset(c, n), country_codes):
+            if country_df is not None:
+                dfs.append(country_df)
+
+    print(f"Spotify response cache: {sp.cache_stats()}, throttled {rate_limiter.throttled} times")
+    print(f"Audio features: {audio_feature_stats['calls']} API calls for {audio_feature_stats['tracks']} tracks, {audio_feature_stats['calls_saved']} calls saved")
 
     if len(dfs) == 0:
         return None
 
-    df = dfs[0]
-    for i in range(1, len(dfs)):
-        df = df.union(dfs[i])
-
-    #df = df.withColumn("index", monotonically_increasing_id())
+    df = set_collection_types(pd.concat(dfs, ignore_index=True))
 
     print("Done!")
+    if as_spark:
+        return to_spark_dataframe(df)
     return df
 print("make_sp_dataset function created")
 
+###Checkpointed collection runs. Each country's result is written once to its
+# own partition file in the run directory, and _manifest.json records which
+# countries (and which of their playlists) have finished. Re-running
+# collect_countries with the same run directory skips everything already in the
+# manifest, so a crash only costs the countries that were in progress.
+# The run directory is a Parquet dataset partitioned by country_code
+# (country_code=US/part-0.parquet), so it can be read directly by Spark or pandas
+# (the leading underscore on _manifest.json makes Spark skip it).
+manifest_lock = threading.Lock()
+
+# Function to write a file through a temporary file that is then renamed into place, so a crash in the middle of
+# writing never leaves a half written file behind. write is called with the temporary path.
+def write_atomic(path, write, tmp_path=None):
+    tmp_path = tmp_path or f'{path}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def write_json_atomic(path, data):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, sort_keys=True, indent=4)
+    write_atomic(path, write)
+
+# Function to read a JSON file, returns default if the file doesn't exist yet
+def read_json(path, default):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return default
+
+# Function to write one country's rows as a typed Parquet partition, returns the file path relative to dataset_dir
+def write_collection_partition(df, dataset_dir, country_code):
+    partition_file = f'country_code={country_code}/part-0.parquet'
+    os.makedirs(f'{dataset_dir}/country_code={country_code}', exist_ok=True)
+    table = pa.Table.from_pandas(set_collection_types(df).drop(columns='country_code'),
+                                 schema=collection_arrow_schema, preserve_index=False)
+    # The temporary file starts with a dot so a half written partition is never picked up by Spark or pyarrow
+    write_atomic(f'{dataset_dir}/{partition_file}', lambda tmp_path: pq.write_table(table, tmp_path),
+                 tmp_path=f'{dataset_dir}/country_code={country_code}/.part-0.parquet.tmp')
+    return partition_file
+
+def read_manifest(run_dir):
+    return read_json(f'{run_dir}/_manifest.json', {'countries': {}})
+
+def write_manifest(run_dir, manifest):
+    write_json_atomic(f'{run_dir}/_manifest.json', manifest)
+
+# Function to make the manifest entry for a finished country, country_df is None when the country had no tracks
+def manifest_entry(country_df, partition_file):
+    entry = {'status': 'done', 'playlists': [], 'rows': 0, 'file': None}
+    if country_df is not None:
+        entry.update({'playlists': sorted(country_df['playlist_id'].unique().tolist()),
+                      'rows': len(country_df), 'file': partition_file})
+    entry['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return entry
+
+def collect_countries(country_codes, run_dir, max_workers=collection_workers, n=None):
+    os.makedirs(run_dir, exist_ok=True)
+    manifest = read_manifest(run_dir)
+    todo = [c for c in country_codes if manifest['countries'].get(c, {}).get('status') != 'done']
+    print(f"{len(country_codes) - len(todo)} countries already collected, {len(todo)} left to collect")
+
+    def collect(country_code):
+        try:
+            country_pd = make_country_dataset(country_code, n)
+            partition_file = None
+            if country_pd is not None:
+                # Only this country's rows are written, so each checkpoint costs O(new data)
+                partition_file = write_collection_partition(country_pd, run_dir, country_code)
+            entry = manifest_entry(country_pd, partition_file)
+        except Exception as e:
+            print(f"Error occurred while collecting {country_code}. Error message: {str(e)}")
+            entry = {'status': 'failed', 'error': str(e), 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+        with manifest_lock:
+            manifest['countries'][country_code] = entry
+            write_manifest(run_dir, manifest)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(collect, todo))
+
+    failed = [c for c in country_codes if manifest['countries'][c]['status'] != 'done']
+    if failed:
+        print(f"{len(failed)} countries failed and will be retried on the next run: {failed}")
+    return read_collection(run_dir, country_codes)
+print("collect_countries function created")
+
+# Function to combine the finished partition files of a run into one dataframe, in the same order as country_codes
+def read_collection(run_dir, country_codes):
+    manifest = read_manifest(run_dir)
+    parts = []
+    for c in country_codes:
+        entry = manifest['countries'].get(c, {})
+        if entry.get('status') == 'done' and entry.get('file'):
+            part = pd.read_parquet(f"{run_dir}/{entry['file']}")
+            part['country_code'] = c
+            parts.append(part)
+    if len(parts) == 0:
+        return None
+    return set_collection_types(pd.concat(parts, ignore_index=True))
+print("read_collection function created")
+
+# Function to convert a CSV exported by the earlier version of the collection (such as world_top_playlists.csv)
+# into the partitioned Parquet dataset, with genre turned back from its "['pop', 'rock']" text into a real list
+def csv_to_parquet(csvFilePath, dataset_dir):
+    # keep_default_na=False so that Namibia's country code "NA" isn't read as a missing value
+    df = pd.read_csv(csvFilePath, keep_default_na=False, na_values=[''])
+    df['genre'] = df['genre'].apply(lambda g: ast.literal_eval(g) if isinstance(g, str) and g.startswith('[') else [])
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = read_manifest(dataset_dir)
+    for country_code, country_df in df.groupby('country_code', sort=False):
+        partition_file = write_collection_partition(country_df, dataset_dir, country_code)
+        manifest['countries'][country_code] = manifest_entry(country_df, partition_file)
+    write_manifest(dataset_dir, manifest)
+print("csv_to_parquet function created")
+
 # Function to convert a CSV to JSON
 # Takes the file paths as arguments
-
-from collections import OrderedDict
-
-def make_json(csvFilePath, jsonFilePath):
-    csv_rows = []
-    with open(csvFilePath, 'r') as csvfile:
+# Rows are streamed one at a time and written as newline-delimited JSON (one object per line),
+# so memory use stays constant and Spark can split the file across partitions when reading it.
+# compression can be None, 'gzip' or 'zstd' (zstd needs the zstandard package: %pip install zstandard).
+# Note that Spark reads a compressed file as a single partition, so leave it uncompressed for the fastest reads.
+
+import gzip
+import io
+
+def open_json_output(jsonFilePath, compression=None):
+    if compression is None:
+        return open(jsonFilePath, 'w', encoding='utf-8')
+    if compression == 'gzip':
+        return gzip.open(jsonFilePath, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        import zstandard
+        raw = open(jsonFilePath, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw, closefd=True), encoding='utf-8')
+    raise ValueError(f"Unknown compression '{compression}', use None, 'gzip' or 'zstd'")
+
+def make_json(csvFilePath, jsonFilePath, compression=None):
+    with open(csvFilePath, 'r', newline='', encoding='utf-8') as csvfile, open_json_output(jsonFilePath, compression) as f:
         reader = csv.DictReader(csvfile)
-        title = reader.fieldnames
         for row in reader:
-            entry = OrderedDict()
-            for field in title:
-                entry[field] = row[field]
-            csv_rows.append(entry)
-
-    with open(jsonFilePath, 'w') as f:
-        json.dump(csv_rows, f, sort_keys=True, indent=4, ensure_ascii=False)
-        f.write('\n')
+            f.write(json.dumps(row, sort_keys=True, ensure_ascii=False))
+            f.write('\n')
 print("make_json function written")
 
 #store a complete list of all country codes that will be iterated through to determine which countries have Spotify.
+#each entry is a (country code, country name) pair
 countries = [
             #A
-            {"AD", "Andorra"},
-            {"AE", "United Arab Emirates"},
-            {"AF", "Afghanistan"},
-            {"AG", "Antigua and Barbuda"},
-            {"AI", "Anguilla"},
-            {"AL", "Albania"},
-            {"AM", "Armenia"},
-            {"AO", "Angola"},
-            {"AQ", "Antarctica"},
-            {"AR", "Argentina"},
-            {"AS", "American Samoa"},
-            {"AT", "Austria"},
-            {"AU", "Australia"},
-            {"AW", "Aruba"},
-            {"AX", "Åland Islands"},
-            {"AZ", "Azerbaijan"},
+            ("AD", "Andorra"),
+            ("AE", "United Arab Emirates"),
+            ("AF", "Afghanistan"),
+            ("AG", "Antigua and Barbuda"),
+            ("AI", "Anguilla"),
+            ("AL", "Albania"),
+            ("AM", "Armenia"),
+            ("AO", "Angola"),
+            ("AQ", "Antarctica"),
+            ("AR", "Argentina"),
+            ("AS", "American Samoa"),
+            ("AT", "Austria"),
+            ("AU", "Australia"),
+            ("AW", "Aruba"),
+            ("AX", "Åland Islands"),
+            ("AZ", "Azerbaijan"),
             #B
-            {"BA", "Bosnia and Herzegovina"},
-            {"BB", "Barbados"},
-            {"BD", "Bangladesh"},
-            {"BE", "Belgium"},
-            {"BF", "Burkina Faso"},
-            {"BG", "Bulgaria"},
-            {"BH", "Bahrain"},
-            {"BI", "Burundi"},
-            {"BJ", "Benin"},
-            {"BL", "Saint Barthélemy"},
-            {"BM", "Bermuda"},
-            {"BN", "Brunei Darussalam"},
-            {"BO", "Bolivia, Plurinational State of"},
-            {"BQ", "Bonaire, Sint Eustatius and Saba"},
-            {"BR", "Brazil"},
-            {"BS", "Bahamas"},
-            {"BT", "Bhutan"},
-            {"BV", "Bouvet Island"},
-            {"BW", "Botswana"},
-            {"BY", "Belarus"},
-            {"BZ", "Belize"},
+            ("BA", "Bosnia and Herzegovina"),
+            ("BB", "Barbados"),
+            ("BD", "Bangladesh"),
+            ("BE", "Belgium"),
+            ("BF", "Burkina Faso"),
+            ("BG", "Bulgaria"),
+            ("BH", "Bahrain"),
+            ("BI", "Burundi"),
+            ("BJ", "Benin"),
+            ("BL", "Saint Barthélemy"),
+            ("BM", "Bermuda"),
+            ("BN", "Brunei Darussalam"),
+            ("BO", "Bolivia, Plurinational State of"),
+            ("BQ", "Bonaire, Sint Eustatius and Saba"),
+            ("BR", "Brazil"),
+            ("BS", "Bahamas"),
+            ("BT", "Bhutan"),
+            ("BV", "Bouvet Island"),
+            ("BW", "Botswana"),
+            ("BY", "Belarus"),
+            ("BZ", "Belize"),
             #C
-            {"CA","Canada"},
-            {"CC","Cocos (Keeling) Islands"},
-            {"CD","Congo, the Democratic Republic of"},
-            {"CF","Central African Republic"},
-            {"CG","Congo"},
-            {"CH","Switzerland"},
-            {"CI","Côte d'Ivoire"},
-            {"CK","Cook Islands"},
-            {"CL","Chile"},
-            {"CM","Cameroon"},
-            {"CN","China"},
-            {"CO","Colombia"},
-            {"CR","Costa Rica"},
-            {"CU","Cuba"},
-            {"CV","Cabo Verde"},
-            {"CW","Curaçao"},
-            {"CX","Christmas Island"},
-            {"CY","Cyprus"},
-            {"CZ","Czech Republic"},
+            ("CA","Canada"),
+            ("CC","Cocos (Keeling) Islands"),
+            ("CD","Congo, the Democratic Republic of"),
+            ("CF","Central African Republic"),
+            ("CG","Congo"),
+            ("CH","Switzerland"),
+            ("CI","Côte d'Ivoire"),
+            ("CK","Cook Islands"),
+            ("CL","Chile"),
+            ("CM","Cameroon"),
+            ("CN","China"),
+            ("CO","Colombia"),
+            ("CR","Costa Rica"),
+            ("CU","Cuba"),
+            ("CV","Cabo Verde"),
+            ("CW","Curaçao"),
+            ("CX","Christmas Island"),
+            ("CY","Cyprus"),
+            ("CZ","Czech Republic"),
             #D
-            {"DE","Germany"},
-            {"DJ","Djibouti"},
-            {"DK","Denmark"},
-            {"DM","Dominica"},
-            {"DO","Dominican Republic"},
-            {"DZ","Algeria"},
+            ("DE","Germany"),
+            ("DJ","Djibouti"),
+            ("DK","Denmark"),
+            ("DM","Dominica"),
+            ("DO","Dominican Republic"),
+            ("DZ","Algeria"),
             #E
-            {"EC","Ecuador"},
-            {"EE","Estonia"},
-            {"EG","Egypt"},
-            {"EH","Western Sahara"},
-            {"ER","Eritrea"},
-            {"ES","Spain"},
-            {"ET","Ethiopia"},
+            ("EC","Ecuador"),
+            ("EE","Estonia"),
+            ("EG","Egypt"),
+            ("EH","Western Sahara"),
+            ("ER","Eritrea"),
+            ("ES","Spain"),
+            ("ET","Ethiopia"),
             #F
-            {"FI","Finland"},
-            {"FJ","Fiji"},
-            {"FK","Falkland Islands (Malvinas)"},
-            {"FM","Micronesia, Federated States of"},
-            {"FO","Faroe Islands"},
-            {"FR","France"},
+            ("FI","Finland"),
+            ("FJ","Fiji"),
+            ("FK","Falkland Islands (Malvinas)"),
+            ("FM","Micronesia, Federated States of"),
+            ("FO","Faroe Islands"),
+            ("FR","France"),
             #G
-            {"GA","Gabon"},
-            {"GB","United Kingdom of Great Britain and Northern Ireland"},
-            {"GD","Grenada"},
-            {"GE","Georgia"},
-            {"GF","French Guiana"},
-            {"GG","Guernsey"},
-            {"GH","Ghana"},
-            {"GI","Gibraltar"},
-            {"GL","Greenland"},
-            {"GM","Gambia"},
-            {"GN","Guinea"},
-            {"GP","Guadeloupe"},
-            {"GQ","Equatorial Guinea"},
-            {"GR","Greece"},
-            {"GS","South Georgia and the South Sandwich Islands"},
-            {"GT","Guatemala"},
-            {"GU","Guam"},
-            {"GW","Guinea-Bissau"},
-            {"GY","Guyana"},
+            ("GA","Gabon"),
+            ("GB","United Kingdom of Great Britain and Northern Ireland"),
+            ("GD","Grenada"),
+            ("GE","Georgia"),
+            ("GF","French Guiana"),
+            ("GG","Guernsey"),
+            ("GH","Ghana"),
+            ("GI","Gibraltar"),
+            ("GL","Greenland"),
+            ("GM","Gambia"),
+            ("GN","Guinea"),
+            ("GP","Guadeloupe"),
+            ("GQ","Equatorial Guinea"),
+            ("GR","Greece"),
+            ("GS","South Georgia and the South Sandwich Islands"),
+            ("GT","Guatemala"),
+            ("GU","Guam"),
+            ("GW","Guinea-Bissau"),
+            ("GY","Guyana"),
             #H
-            {"HK","Hong Kong"},
-            {"HM","Heard Island and McDonalds Islands"},
-            {"HN","Honduras"},
-            {"HR","Croatia"},
-            {"HT","Haiti"},
-            {"HU","Hungary"},
+            ("HK","Hong Kong"),
+            ("HM","Heard Island and McDonalds Islands"),
+            ("HN","Honduras"),
+            ("HR","Croatia"),
+            ("HT","Haiti"),
+            ("HU","Hungary"),
             #I
-            {"ID","Indonesia"},
-            {"IE","Ireland"},
-            {"IL","Israel"},
-            {"IM","Isle of Man"},
-            {"IN","India"},
-            {"IO","British Indian Ocean Territory"},
-            {"IQ","Iraq"},
-            {"IR","Iran, Islamic Republic of"},
-            {"IS","Iceland"},
-            {"IT","Italy"},
+            ("ID","Indonesia"),
+            ("IE","Ireland"),
+            ("IL","Israel"),
+            ("IM","Isle of Man"),
+            ("IN","India"),
+            ("IO","British Indian Ocean Territory"),
+            ("IQ","Iraq"),
+            ("IR","Iran, Islamic Republic of"),
+            ("IS","Iceland"),
+            ("IT","Italy"),
             #J
-            {"JE","Jersey"},
-            {"JM","Jamaica"},
-            {"JO","Jordan"},
-            {"JP","Japan"},
+            ("JE","Jersey"),
+            ("JM","Jamaica"),
+            ("JO","Jordan"),
+            ("JP","Japan"),
             #K
-            {"KE","Kenya"},
-            {"KG","Kyrgyzstan"},
-            {"KH","Cambodia"},
-            {"KI","Kiribati"},
-            {"KM","Comoros"},
-            {"KN","Saint Kitts and Nevis"},
-            {"KP","Korea, Democratic People's Republic of"},
-            {"KR","Korea, Republic of"},
-            {"KW","Kuwait"},
-            {"KY","Cayman Islands"},
-            {"KZ","Kazakhstan"},
+            ("KE","Kenya"),
+            ("KG","Kyrgyzstan"),
+            ("KH","Cambodia"),
+            ("KI","Kiribati"),
+            ("KM","Comoros"),
+            ("KN","Saint Kitts and Nevis"),
+            ("KP","Korea, Democratic People's Republic of"),
+            ("KR","Korea, Republic of"),
+            ("KW","Kuwait"),
+            ("KY","Cayman Islands"),
+            ("KZ","Kazakhstan"),
             #L
-            {"LA","Lao People's Democratic Republic"},
-            {"LB","Lebanon"},
-            {"LC","Saint Lucia"},
-            {"LI","Liechtenstein"},
-            {"LK","Sri Lanka"},
-            {"LR","Liberia"},
-            {"LS","Lesotho"},
-            {"LT","Lithuania"},
-            {"LU","Luxembourg"},
-            {"LV","Latvia"},
+            ("LA","Lao People's Democratic Republic"),
+            ("LB","Lebanon"),
+            ("LC","Saint Lucia"),
+            ("LI","Liechtenstein"),
+            ("LK","Sri Lanka"),
+            ("LR","Liberia"),
+            ("LS","Lesotho"),
+            ("LT","Lithuania"),
+            ("LU","Luxembourg"),
+            ("LV","Latvia"),
             #M
-            {"MA","Morocco"},
-            {"MC","Monaco"},
-            {"MD","Moldova, Republic of"},
-            {"ME","Montenegro"},
-            {"MF","Saint Martin (French part)"},
-            {"MG","Madagascar"},
-            {"MH","Marshall Islands"},
-            {"MK","Macedonia, the former Yugoslav Republic of"},
-            {"ML","Mali"},
-            {"MM","Myanmar"},
-            {"MN","Mongolia"},
-            {"MO","Macao"},
-            {"MP","Northern Mariana Islands"},
-            {"MQ","Martinique"},
-            {"MR","Mauritania"},
-            {"MS","Montserrat"},
-            {"MT","Malta"},
-            {"MU","Mauritius"},
-            {"MV","Maldives"},
-            {"MW","Malawi"},
-            {"MX","Mexico"},
-            {"MY","Malaysia"},
-            {"MZ","Mozambique"},
+            ("MA","Morocco"),
+            ("MC","Monaco"),
+            ("MD","Moldova, Republic of"),
+            ("ME","Montenegro"),
+            ("MF","Saint Martin (French part)"),
+            ("MG","Madagascar"),
+            ("MH","Marshall Islands"),
+            ("MK","Macedonia, the former Yugoslav Republic of"),
+            ("ML","Mali"),
+            ("MM","Myanmar"),
+            ("MN","Mongolia"),
+            ("MO","Macao"),
+            ("MP","Northern Mariana Islands"),
+            ("MQ","Martinique"),
+            ("MR","Mauritania"),
+            ("MS","Montserrat"),
+            ("MT","Malta"),
+            ("MU","Mauritius"),
+            ("MV","Maldives"),
+            ("MW","Malawi"),
+            ("MX","Mexico"),
+            ("MY","Malaysia"),
+            ("MZ","Mozambique"),
             #N
-            {"NA","Namibia"},
-            {"NC","New Caledonia"},
-            {"NE","Niger"},
-            {"NF","Norfolk Island"},
-            {"NG","Nigeria"},
-            {"NI","Nicaragua"},
-            {"NL","Netherlands"},
-            {"NO","Norway"},
-            {"NP","Nepal"},
-            {"NR","Nauru"},
-            {"NU","Niue"},
-            {"NZ","New Zealand"},
+            ("NA","Namibia"),
+            ("NC","New Caledonia"),
+            ("NE","Niger"),
+            ("NF","Norfolk Island"),
+            ("NG","Nigeria"),
+            ("NI","Nicaragua"),
+            ("NL","Netherlands"),
+            ("NO","Norway"),
+            ("NP","Nepal"),
+            ("NR","Nauru"),
+            ("NU","Niue"),
+            ("NZ","New Zealand"),
             #O
-            {"OM","Oman"},
+            ("OM","Oman"),
             #P
-            {"PA","Panama"},
-            {"PE","Peru"},
-            {"PF","French Polynesia"},
-            {"PG","Papua New Guinea"},
-            {"PH","Philippines"},
-            {"PK","Pakistan"},
-            {"PL","Poland"},
-            {"PM","Saint Pierre and Miquelon"},
-            {"PN","Pitcairn"},
-            {"PR","Puerto Rico"},
-            {"PS","Palestine, State of"},
-            {"PT","Portugal"},
-            {"PW","Palau"},
-            {"PY","Paraguay"},
+            ("PA","Panama"),
+            ("PE","Peru"),
+            ("PF","French Polynesia"),
+            ("PG","Papua New Guinea"),
+            ("PH","Philippines"),
+            ("PK","Pakistan"),
+            ("PL","Poland"),
+            ("PM","Saint Pierre and Miquelon"),
+            ("PN","Pitcairn"),
+            ("PR","Puerto Rico"),
+            ("PS","Palestine, State of"),
+            ("PT","Portugal"),
+            ("PW","Palau"),
+            ("PY","Paraguay"),
             #Q
-            {"QA","Qatar"},
+            ("QA","Qatar"),
             #R
-            {"RE","Réunion"},
-            {"RO","Romania"},
-            {"RS","Serbia"},
-            {"RU","Russian Federation"},
-            {"RW","Rwanda"},
+            ("RE","Réunion"),
+            ("RO","Romania"),
+            ("RS","Serbia"),
+            ("RU","Russian Federation"),
+            ("RW","Rwanda"),
             #S
-            {"SA","Saudi Arabia"},
-            {"SB","Solomon Islands"},
-            {"SC","Seychelles"},
-            {"SD","Sudan"},
-            {"SE","Sweden"},
-            {"SG","Singapore"},
-            {"SH","Saint Helena, Ascension and Tristan da Cunha"},
-            {"SI","Slovenia"},
-            {"SJ","Svalbard and Jan Mayen"},
-            {"SK","Slovakia"},
-            {"SL","Sierra Leone"},
-            {"SM","San Marino"},
-            {"SN","Senegal"},
-            {"SO","Somalia"},
-            {"SR","Suriname"},
-            {"SS","South Sudan"},
-            {"ST","Sao Tome and Principe"},
-            {"SV","El Salvador"},
-            {"SX","Sint Maarten (Dutch part)"},
-            {"SY","Syrian Arab Republic"},
-            {"SZ","Swaziland"},
+            ("SA","Saudi Arabia"),
+            ("SB","Solomon Islands"),
+            ("SC","Seychelles"),
+            ("SD","Sudan"),
+            ("SE","Sweden"),
+            ("SG","Singapore"),
+            ("SH","Saint Helena, Ascension and Tristan da Cunha"),
+            ("SI","Slovenia"),
+            ("SJ","Svalbard and Jan Mayen"),
+            ("SK","Slovakia"),
+            ("SL","Sierra Leone"),
+            ("SM","San Marino"),
+            ("SN","Senegal"),
+            ("SO","Somalia"),
+            ("SR","Suriname"),
+            ("SS","South Sudan"),
+            ("ST","Sao Tome and Principe"),
+            ("SV","El Salvador"),
+            ("SX","Sint Maarten (Dutch part)"),
+            ("SY","Syrian Arab Republic"),
+            ("SZ","Swaziland"),
             #T
-            {"TC","Turks and Caicos Islands"},
-            {"TD","Chad"},
-            {"TF","French Southern Territories"},
-            {"TG","Togo"},
-            {"TH","Thailand"},
-            {"TJ","Tajikistan"},
-            {"TK","Tokelau"},
-            {"TL","Timor-Leste"},
-            {"TM","Turkmenistan"},
-            {"TN","Tunisia"},
-            {"TO","Tonga"},
-            {"TR","Turkey"},
-            {"TT","Tuvalu"},
-            {"TW","Taiwan, Province of China"},
-            {"TZ","Tanzania, United Republic of"},
+            ("TC","Turks and Caicos Islands"),
+            ("TD","Chad"),
+            ("TF","French Southern Territories"),
+            ("TG","Togo"),
+            ("TH","Thailand"),
+            ("TJ","Tajikistan"),
+            ("TK","Tokelau"),
+            ("TL","Timor-Leste"),
+            ("TM","Turkmenistan"),
+            ("TN","Tunisia"),
+            ("TO","Tonga"),
+            ("TR","Turkey"),
+            ("TT","Tuvalu"),
+            ("TW","Taiwan, Province of China"),
+            ("TZ","Tanzania, United Republic of"),
             #U
-            {"UA","Ukraine"},
-            {"UG","Uganda"},
-            {"UM","United States Minor Outlying Islands"},
-            {"US","United States of America"},
-            {"UY","Uruguay"},
-            {"UZ","Uzbekistan"},
+            ("UA","Ukraine"),
+            ("UG","Uganda"),
+            ("UM","United States Minor Outlying Islands"),
+            ("US","United States of America"),
+            ("UY","Uruguay"),
+            ("UZ","Uzbekistan"),
             #V
-            {"VA","Holy See"},
-            {"VC","Saint Vincent and the Grenadines"},
-            {"VE","Venezuela, Bolivarian Republic of"},
-            {"VG","Virgin Islands, British"},
-            {"VI","Virgin Islands, U.S."},
-            {"VN","Viet Nam"},
-            {"VU","Vanuatu"},
+            ("VA","Holy See"),
+            ("VC","Saint Vincent and the Grenadines"),
+            ("VE","Venezuela, Bolivarian Republic of"),
+            ("VG","Virgin Islands, British"),
+            ("VI","Virgin Islands, U.S."),
+            ("VN","Viet Nam"),
+            ("VU","Vanuatu"),
             #W
-            {"WF","Wallis and Futuna"},
-            {"WS","Samoa"},
+            ("WF","Wallis and Futuna"),
+            ("WS","Samoa"),
             #Y
-            {"YE","Yemen"},
-            {"YT","Mayotte"},
+            ("YE","Yemen"),
+            ("YT","Mayotte"),
             #Z
-            {"ZA","South Africa"},
-            {"ZM","Zambia"},
-            {"ZW","Zimbabwe"}
+            ("ZA","South Africa"),
+            ("ZM","Zambia"),
+            ("ZW","Zimbabwe")
 ]
 print("Countries list created")
 
+# Lookup table from country code to country name, built from the countries list the first time it is used.
+# Lookups are dictionary reads, so resolving names costs the same at any batch size, and the lock makes sure
+# collection threads racing on the first lookup only build it once.
+class CountryRegistry:
+    def __init__(self, table):
+        self.table = table
+        self.names = None
+        self.lock = threading.Lock()
+
+    def lookup(self):
+        if self.names is None:
+            with self.lock:
+                if self.names is None:
+                    self.names = dict(self.table)
+        return self.names
+
+    def name(self, country_code):
+        try:
+            return self.lookup()[country_code]
+        except KeyError:
+            raise KeyError(f"Unknown country code '{country_code}'") from None
+
+    # The names for a list of codes, in the same order as the codes
+    def names_for(self, country_codes):
+        return [self.name(c) for c in country_codes]
+
+    # All the country codes, in the order of the countries list
+    def codes(self):
+        return list(self.lookup())
+
+country_registry = CountryRegistry(countries)
+
 ######get a list of just the country codes
-countryCodeList=[]
-for i in range(len(countries)):
-    for x in countries[i]:
-        if len(x)==2:
-            countryCodeList.append(x)
-
-#Not all countries have Spotify. This function tests which countries currently do have Spotify and which do not, and then seperates them into two different lists.
-'''working_countrycode_list = []
-fail_countrycode_list = []
-for i in countryCodeList:
+countryCodeList = country_registry.codes()
+
+#Not all countries have Spotify. These functions test which countries currently do have Spotify and which do not, and then seperate them into two different lists.
+# The result for each country is saved with the time it was checked in a local JSON file, and later runs only
+# re-check countries whose result is older than market_cache_ttl or whose check failed. Only the statuses Spotify
+# answers with for an unsupported market (unsupported_market_statuses) count as the country not having Spotify;
+# anything else (a network error, server errors, or a 401/403 from bad credentials) is a failed check.
+# The probes call the spotipy client directly (sp.client) so they skip the response cache, and run in parallel
+# under the shared rate limiter.
+market_cache_ttl = 7 * 24 * 60 * 60
+market_probe_workers = 8
+unsupported_market_statuses = {400, 404}
+
+# Function to check one country code, returns 'available', 'unavailable' or 'failed'
+def probe_market(country_code):
     try:
-        get_top_playlists([i])
-        working_countrycode_list.append(i)
-    except:
-        print(f'{i} does not have Spotify yet')
-        fail_countrycode_list.append(i)'''
-
-#results in 181 countries/country codes that we can get featured playlists for, 66 countries that we cannot:
-working_countrycode_list=['AD',
- 'AE',
- 'AG',
- 'AL',
- 'AM',
- 'AO',
- 'AR',
- 'AT',
- 'AU',
- 'AZ',
- 'BA',
- 'BB',
- 'BD',
- 'BE',
- 'BF',
- 'BG',
- 'BH',
- 'BI',
- 'BJ',
- 'BN',
- 'BO',
- 'BR',
- 'BS',
- 'BT',
- 'BW',
- 'BY',
- 'BZ',
- 'CA',
- 'CD',
- 'CG',
- 'CH',
- 'CI',
- 'CL',
- 'CM',
- 'CO',
- 'CR',
- 'CV',
- 'CW',
- 'CY',
- 'CZ',
- 'DE',
- 'DJ',
- 'DK',
- 'DM',
- 'DO',
- 'DZ',
- 'EC',
- 'EE',
- 'EG',
- 'ES',
- 'ET',
- 'FI',
- 'FJ',
- 'FM',
- 'FR',
- 'GA',
- 'GB',
- 'GD',
- 'GE',
- 'GH',
- 'GM',
- 'GN',
- 'GQ',
- 'GR',
- 'GT',
- 'GW',
- 'GY',
- 'HK',
- 'HN',
- 'HR',
- 'HT',
- 'HU',
- 'ID',
- 'IE',
- 'IL',
- 'IN',
- 'IQ',
- 'IS',
- 'IT',
- 'JM',
- 'JO',
- 'JP',
- 'KE',
- 'KG',
- 'KH',
- 'KI',
- 'KM',
- 'KN',
- 'KR',
- 'KW',
- 'KZ',
- 'LA',
- 'LB',
- 'LC',
- 'LI',
- 'LK',
- 'LR',
- 'LS',
- 'LT',
- 'LU',
- 'LV',
- 'MA',
- 'MC',
- 'MD',
- 'ME',
- 'MG',
- 'MH',
- 'MK',
- 'ML',
- 'MN',
- 'MO',
- 'MR',
- 'MT',
- 'MU',
- 'MV',
- 'MW',
- 'MX',
- 'MY',
- 'MZ',
- 'NA',
- 'NE',
- 'NG',
- 'NI',
- 'NL',
- 'NO',
- 'NP',
- 'NR',
- 'NZ',
- 'OM',
- 'PA',
- 'PE',
- 'PG',
- 'PH',
- 'PK',
- 'PL',
- 'PS',
- 'PT',
- 'PW',
- 'PY',
- 'QA',
- 'RO',
- 'RS',
- 'RW',
- 'SA',
- 'SB',
- 'SC',
- 'SE',
- 'SG',
- 'SI',
- 'SK',
- 'SL',
- 'SM',
- 'SN',
- 'SR',
- 'ST',
- 'SV',
- 'SZ',
- 'TD',
- 'TG',
- 'TH',
- 'TJ',
- 'TL',
- 'TN',
- 'TO',
- 'TR',
- 'TT',
- 'TW',
- 'TZ',
- 'UA',
- 'UG',
- 'US',
- 'UY',
- 'UZ',
- 'VC',
- 'VE',
- 'VN',
- 'VU',
- 'WS',
- 'ZA',
- 'ZM',
- 'ZW']
-fail_countrycode_list=['AF',
- 'AI',
- 'AQ',
- 'AS',
- 'AW',
- 'AX',
- 'BL',
- 'BM',
- 'BQ',
- 'BV',
- 'CC',
- 'CF',
- 'CK',
- 'CN',
- 'CU',
- 'CX',
- 'EH',
- 'ER',
- 'FK',
- 'FO',
- 'GF',
- 'GG',
- 'GI',
- 'GL',
- 'GP',
- 'GS',
- 'GU',
- 'HM',
- 'IM',
- 'IO',
- 'IR',
- 'JE',
- 'KP',
- 'KY',
- 'MF',
- 'MM',
- 'MP',
- 'MQ',
- 'MS',
- 'NC',
- 'NF',
- 'NU',
- 'PF',
- 'PM',
- 'PN',
- 'PR',
- 'RE',
- 'RU',
- 'SD',
- 'SH',
- 'SJ',
- 'SO',
- 'SS',
- 'SX',
- 'SY',
- 'TC',
- 'TF',
- 'TK',
- 'TM',
- 'UM',
- 'VA',
- 'VG',
- 'VI',
- 'WF',
- 'YE',
- 'YT']
+        rate_limiter.call(sp.client.featured_playlists, country = country_code, limit = 1)
+        return 'available'
+    except spotipy.SpotifyException as e:
+        if e.http_status in unsupported_market_statuses:
+            return 'unavailable'
+        print(f"Could not check {country_code}. Error message: {str(e)}")
+        return 'failed'
+    except Exception as e:
+        print(f"Could not check {country_code}. Error message: {str(e)}")
+        return 'failed'
+
+# Function to split country codes into the ones that have Spotify and the ones that don't, in the order given
+def get_market_availability(country_codes, cache_path, max_age=market_cache_ttl, max_workers=market_probe_workers):
+    cache = read_json(cache_path, {})
+    now = time.time()
+    stale = [c for c in country_codes if c not in cache or cache[c]['status'] == 'failed'
+             or now - cache[c]['checked'] > max_age]
+    print(f"{len(country_codes) - len(stale)} markets cached, checking {len(stale)}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        statuses = list(executor.map(probe_market, stale))
+    for c, status in zip(stale, statuses):
+        cache[c] = {'status': status, 'checked': time.time(), 'checked_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if stale:
+        write_json_atomic(cache_path, cache)
+
+    working = [c for c in country_codes if cache[c]['status'] == 'available']
+    failed = [c for c in country_codes if cache[c]['status'] != 'available']
+    for c in failed:
+        if cache[c]['status'] == 'failed':
+            print(f'{c} could not be checked and will be checked again on the next run')
+    return working, failed
+print("get_market_availability function created")
+
+#when last checked this resulted in 181 countries/country codes that we can get featured playlists for, 66 countries that we cannot
+working_countrycode_list, fail_countrycode_list = get_market_availability(countryCodeList, f'{default_directory}/datafiles/market_availability.json')
 
 print(len(working_countrycode_list))
 print(len(fail_countrycode_list))
@@ -854,258 +1126,394 @@ print(len(fail_countrycode_list))
 ################################################################################
 
 #####function for staggering data collection so that the API doesn't lock us out but also doesn't timeout
+# (the pacing is now handled by rate_limiter, so there are no fixed pauses between countries)
 #IMPORTANT NOTE# This code took a while to run, so once it finished I
 # exported the CSV file so that it can just be imported going forward.
 # There is code to import it at the top of the page already, the file is world_top_playlists
-'''count=0
-schema = StructType([])
-ds_full_list=spark.createDataFrame([],schema)
-for i in range(0,len(working_countrycode_list)):
-    temp_df=make_sp_dataset([working_countrycode_list[i]])
-    if len(ds_full_list.columns)==0:
-        ds_full_list=temp_df
-    else:
-        ds_full_list=ds_full_list.union(temp_df)
-    count=count+1
-    if count == 5:
-        ds_full_list.toPandas().to_csv(f'{default_directory}/datafiles/top_playlists_{working_countrycode_list[0]}to{working_countrycode_list[i]}.csv', index = False, header = True)
-        count=0
-        print('Pausing for 3 minutes...')
-        time.sleep(180)'''
-
-#use the csv to json function to convert the world_top_playlists to a json:
-make_json('world_top_playlists.csv', 'world_top_playlists.json')
+# Spotify responses are now cached in datafiles/spotify_cache.sqlite, so re-running
+# this after a crash or for new countries only requests data that isn't cached yet.
+# Each country is checkpointed as soon as it finishes, so if the run stops just
+# run this again with the same run directory and it will pick up where it left off.
+# The result is the world_top_playlists Parquet dataset, partitioned by country_code.
+world_top_playlists_dir = f'{default_directory}/datafiles/world_top_playlists'
+'''ds_full_list=collect_countries(working_countrycode_list, world_top_playlists_dir)'''
+
+#if the dataset hasn't been collected yet, convert the exported world_top_playlists csv into it instead:
+if not os.path.exists(f'{world_top_playlists_dir}/_manifest.json'):
+    csv_to_parquet(f'{default_directory}/datafiles/world_top_playlists.csv', world_top_playlists_dir)
+
+#make_json can still be used to share the csv as (newline-delimited) JSON, it is no longer part of the pipeline:
+#make_json(f'{default_directory}/datafiles/world_top_playlists.csv', f'{default_directory}/datafiles/world_top_playlists.json')
 
 ################################################################################
 ### Now use neo4j to analyze the data ##########################################
 ################################################################################
 
-file_name = "file:///f'{default_directory}/datafiles/world_top_playlists.json'"
-all_json_df=spark.read.option("multiline", True).option("header", True).json(file_name)
-all_json_df=all_json_df.withColumn('genre',translate('genre','[]\'','')).withColumn('genreList',split(col('genre'),',').alias('genreList')).drop('genre')
-all_json_df.toPandas()
-
-"""***before beginning, ensure elements don't exist in neo4j already (run in neo4j)***
-
-DROP CONSTRAINT con_albumID; \
-DROP CONSTRAINT con_artistID; \
-DROP CONSTRAINT con_countryCode; \
-DROP CONSTRAINT con_genreName; \
-DROP CONSTRAINT con_playlistID; \
-DROP CONSTRAINT con_trackID; \
-
-MATCH (p:Playlists) DETACH DELETE p; \
-MATCH (t:Tracks) DETACH DELETE t; \
-MATCH (a:Artists) DETACH DELETE a; \
-MATCH (a:Albums) DETACH DELETE a; \
-MATCH (c:Countries) DETACH DELETE c; \
-MATCH (g:GenreCounts) DETACH DELETE gc
-"""
+#the Parquet dataset keeps its types, so genre is already an array column and only needs renaming
+all_json_df=spark.read.parquet(world_top_playlists_dir)
+all_json_df=all_json_df.withColumnRenamed('genre','genreList')
+all_json_df.printSchema()
+
+###The nodes are loaded with the neo4j Python driver instead of the Spark connector.
+# Each entity set is de-duplicated in Spark first (one artist row per artist_id,
+# one album row per album_id, etc.), then sent as "UNWIND $batch AS event" MERGE
+# statements of ingest_batch_size rows, so each label costs one statement per
+# batch instead of one write per input row. all_json_df is cached so the
+# dataset is only read once for all of the entity sets.
+from neo4j import GraphDatabase
+
+neo4j_driver = GraphDatabase.driver(bolt_url, auth = neo4j_auth)
+ingest_batch_size = 1000
+all_json_df.cache()
+
+# Function to turn a spark Row into a plain Python dict the neo4j driver can send. Integer columns stay Python ints
+# even when they contain nulls, and NaN is sent as null like a missing value.
+def to_neo4j_record(row):
+    return {k: (None if isinstance(v, float) and v != v else v) for k, v in row.asDict(recursive=True).items()}
+
+# Function to send the rows of a spark dataframe to neo4j in batches, the cypher gets each batch as $batch.
+# Rows are streamed from the executors a partition at a time, so only one batch is held on the driver.
+def run_batched(cypher, df, batch_size=ingest_batch_size):
+    rows = 0
+    statements = 0
+    batch = []
+    with neo4j_driver.session() as session:
+        for row in df.toLocalIterator():
+            batch.append(to_neo4j_record(row))
+            if len(batch) == batch_size:
+                session.run(cypher, batch = batch).consume()
+                rows += len(batch)
+                statements += 1
+                batch = []
+        if batch:
+            session.run(cypher, batch = batch).consume()
+            rows += len(batch)
+            statements += 1
+    print(f"{rows} rows written in {statements} statements")
+print("run_batched function created")
+
+# Function to run a cypher statement a single time (for queries that work on the graph itself rather than on input rows)
+# Any keyword arguments are passed as query parameters, and the result records are returned as a list of dicts
+def run_cypher(cypher, **params):
+    with neo4j_driver.session() as session:
+        return session.run(cypher, **params).data()
+print("run_cypher function created")
+
+#create the constraints once, up front (IF NOT EXISTS makes this safe to re-run)
+cypher_constraints=[
+    "CREATE CONSTRAINT con_playlistID IF NOT EXISTS FOR (p:Playlists) REQUIRE p.playlistID IS UNIQUE",
+    "CREATE CONSTRAINT con_trackID IF NOT EXISTS FOR (t:Tracks) REQUIRE t.trackID IS UNIQUE",
+    "CREATE CONSTRAINT con_artistID IF NOT EXISTS FOR (a:Artists) REQUIRE a.artistID IS UNIQUE",
+    "CREATE CONSTRAINT con_albumID IF NOT EXISTS FOR (a:Albums) REQUIRE a.albumID IS UNIQUE",
+    "CREATE CONSTRAINT con_countryCode IF NOT EXISTS FOR (c:Countries) REQUIRE c.countryCode IS UNIQUE",
+    "CREATE CONSTRAINT con_genreName IF NOT EXISTS FOR (g:GenreCounts) REQUIRE g.genreName IS UNIQUE"]
+
+for cypher in cypher_constraints:
+    run_cypher(cypher)
+print("constraints created")
+
+###Incremental loading. Every Tracks and Playlists node stores a contentHash of
+# the data it was written from (a playlist's hash includes its list of tracks).
+# The new snapshot's hashes are compared with the ones already in Neo4j, and
+# only added or changed tracks and playlists (and the edges around them) are
+# written, while tracks and playlists that are no longer in the snapshot are
+# removed. The constraints are left in place, so a daily refresh only touches
+# what changed. Set load_mode to 'full' to clear the nodes and rebuild
+# everything instead (this replaces the old manual DROP/DETACH DELETE step).
+load_mode = 'incremental'
+
+if load_mode == 'full':
+    for label in ['Playlists', 'Tracks', 'Artists', 'Albums', 'Countries', 'GenreCounts']:
+        run_cypher(f"MATCH (n:{label}) DETACH DELETE n")
+    print("graph cleared for a full load")
+
+from pyspark.sql import Window
+from pyspark.sql.functions import sha2, concat_ws, array_sort, collect_set, row_number
+from pyspark.sql.functions import min as spark_min
+
+#one row per track, taken from the first playlist it appears on (by country code, then playlist id) so the
+#row, and therefore its hash, is the same every time the snapshot is loaded
+track_hash_columns = ['track_name', 'artist', 'artist_id', 'album', 'album_id', 'explicit', 'popularity'] + feature_list + ['norm_tempo']
+tracks_df = all_json_df.withColumn('row_number', row_number().over(Window.partitionBy('track_id').orderBy('country_code', 'playlist_id')))\
+    .filter(col('row_number') == 1).drop('row_number')\
+    .withColumn('content_hash', sha2(concat_ws('|', *[col(c).cast('string') for c in track_hash_columns], concat_ws(',', 'genreList')), 256))\
+    .cache()
+
+#one row per playlist, with a hash of its name, the sorted codes of every country featuring it and its sorted track ids
+#(editorial playlists are often featured in several markets, so a country starting or stopping to feature one changes it)
+playlists_df = all_json_df.groupBy('playlist_id')\
+    .agg(spark_min('top_playlist_name').alias('top_playlist_name'), spark_min('country_code').alias('country_code'),
+         array_sort(collect_set('country_code')).alias('country_codes'), array_sort(collect_set('track_id')).alias('track_ids'))\
+    .withColumn('content_hash', sha2(concat_ws('|', 'top_playlist_name', concat_ws(',', 'country_codes'), concat_ws(',', 'track_ids')), 256))\
+    .drop('country_codes', 'track_ids')\
+    .cache()
+
+# Function to compare the new snapshot's hashes with the ones stored on the nodes already in Neo4j
+# new_hashes is a pandas dataframe with the key column and content_hash, returns the added, changed and removed keys
+def diff_snapshot(label, key_property, key_column, new_hashes):
+    existing = pd.DataFrame(run_cypher(f"MATCH (n:{label}) RETURN n.{key_property} AS {key_column}, n.contentHash AS content_hash"),
+                            columns=[key_column, 'content_hash'])
+    merged = new_hashes.merge(existing, on=key_column, how='outer', suffixes=('', '_old'), indicator=True)
+    added = merged.loc[merged['_merge'] == 'left_only', key_column].tolist()
+    changed = merged.loc[(merged['_merge'] == 'both') & (merged['content_hash'] != merged['content_hash_old']), key_column].tolist()
+    removed = merged.loc[merged['_merge'] == 'right_only', key_column].tolist()
+    print(f"{label}: {len(added)} added, {len(changed)} changed, {len(removed)} removed, "
+          f"{len(merged) - len(added) - len(changed) - len(removed)} unchanged")
+    return added, changed, removed
+print("diff_snapshot function created")
+
+added_tracks, changed_tracks, removed_tracks = diff_snapshot('Tracks', 'trackID', 'track_id', tracks_df.select('track_id', 'content_hash').toPandas())
+added_playlists, changed_playlists, removed_playlists = diff_snapshot('Playlists', 'playlistID', 'playlist_id', playlists_df.select('playlist_id', 'content_hash').toPandas())
+
+# Function to keep only the rows of a spark dataframe whose key is in a list of keys
+def filter_keys(df, key_column, keys):
+    return df.join(spark.createDataFrame([(k,) for k in keys], f'{key_column} string'), on=key_column, how='inner')
+
+write_tracks_df = filter_keys(tracks_df, 'track_id', added_tracks + changed_tracks).cache()
+write_playlists_df = filter_keys(playlists_df, 'playlist_id', added_playlists + changed_playlists).cache()
+write_rows_df = filter_keys(all_json_df, 'playlist_id', added_playlists + changed_playlists).cache()
+
+#the countries whose COUNTRY_TRACKS/COUNTRY_GENRE edges need rebuilding: every country featuring an added or changed
+#playlist in the new snapshot, plus every country a changed or removed playlist was POPULAR_IN in the graph
+old_playlist_countries = run_cypher('''
+UNWIND $ids AS id
+MATCH (p:Playlists{playlistID:id}) - [:POPULAR_IN] -> (c:Countries)
+RETURN DISTINCT c.countryCode AS country_code
+''', ids = changed_playlists + removed_playlists)
+affected_countries = sorted(set(r['country_code'] for r in old_playlist_countries) |
+                            set(r['country_code'] for r in write_rows_df.select('country_code').distinct().collect()))
+#COUNTRY_GENRE edges also depend on the genres of the tracks, so countries with a changed track are rebuilt as well
+genre_countries = sorted(set(affected_countries) |
+                         set(r['country_code'] for r in filter_keys(all_json_df.select('country_code', 'track_id'), 'track_id', changed_tracks)
+                             .select('country_code').distinct().collect()))
+
+#clear the edges of the changed tracks and playlists (they are rebuilt from the new rows below),
+#then remove the tracks and playlists that are no longer in the snapshot
+cypher_clear_Tracks='''
+UNWIND $ids AS id
+MATCH (t:Tracks{trackID:id}) - [r] - ()
+WHERE type(r) IN ['PERFORMS', 'CONTAINS', 'IS_TYPE']
+DELETE r
+'''
+cypher_clear_Playlists='''
+UNWIND $ids AS id
+MATCH (p:Playlists{playlistID:id}) - [r] - ()
+WHERE type(r) IN ['ADDED_TO', 'POPULAR_IN']
+DELETE r
+'''
+cypher_clear_CountryTracks='''
+UNWIND $ids AS id
+MATCH (c:Countries{countryCode:id}) - [r:COUNTRY_TRACKS] -> ()
+DELETE r
+'''
+cypher_clear_CountryGenres='''
+UNWIND $ids AS id
+MATCH (c:Countries{countryCode:id}) - [r:COUNTRY_GENRE] -> ()
+DELETE r
+'''
+run_cypher(cypher_clear_Tracks, ids = changed_tracks)
+run_cypher(cypher_clear_Playlists, ids = changed_playlists)
+run_cypher(cypher_clear_CountryTracks, ids = affected_countries)
+run_cypher(cypher_clear_CountryGenres, ids = genre_countries)
+run_cypher("UNWIND $ids AS id MATCH (t:Tracks{trackID:id}) DETACH DELETE t", ids = removed_tracks)
+run_cypher("UNWIND $ids AS id MATCH (p:Playlists{playlistID:id}) DETACH DELETE p", ids = removed_playlists)
 
 #create the Playlists node labels
+#(the playlist's tracks are linked with ADDED_TO edges below, so the node doesn't hold a list of track ids)
 cypher_Playlists='''
+UNWIND $batch AS event
 MERGE (p:Playlists{playlistID:event.playlist_id})
-ON CREATE SET p.playlistName=event.top_playlist_name, p.countryCode=event.country_code,p.trackID=[event.track_id]
-ON MATCH SET p.trackID=p.trackID+event.track_id
+SET p.playlistName=event.top_playlist_name, p.countryCode=event.country_code, p.contentHash=event.content_hash
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_playlistID FOR (p:Playlists) REQUIRE p.playlistID IS UNIQUE;""")\
-    .option("query", cypher_Playlists)\
-    .save()
+run_batched(cypher_Playlists, write_playlists_df)
 print(cypher_Playlists)
 
 #create the Tracks node labels
 cypher_Tracks='''
+UNWIND $batch AS event
 MERGE (t:Tracks {trackID:event.track_id})
-ON CREATE SET
+SET
 t.trackName=event.track_name,
 t.artistID=event.artist_id,
 t.albumID=event.album_id,
 t.trackName=event.track_name,
-t.explicit=toBoolean(event.explicit),
-t.duration=toInteger(event.duration_ms),
-t.acousticness=toFloat(event.acousticness),
-t.danceability=toFloat(event.danceability),
-t.energy=toFloat(event.energy),
-t.index=event.index,
-t.instrumentalness=toFloat(event.instrumentalness),
-t.key=toInteger(event.key),
-t.liveness=toFloat(event.liveness),
-t.loudness=toFloat(event.loudness),
-t.mode=toInteger(event.mode),
-t.normTempo=toFloat(event.norm_tempo),
-t.popularity=toInteger(event.popularity),
-t.speechiness=toFloat(event.speechiness),
-t.tempo=toFloat(event.tempo),
-t.timeSignature=toFloat(event.time_signature),
-t.valence=toFloat(event.valence),
-t.genre=toStringList(event.genreList)
+t.explicit=event.explicit,
+t.duration=event.duration_ms,
+t.acousticness=event.acousticness,
+t.danceability=event.danceability,
+t.energy=event.energy,
+t.instrumentalness=event.instrumentalness,
+t.key=event.key,
+t.liveness=event.liveness,
+t.loudness=event.loudness,
+t.mode=event.mode,
+t.normTempo=event.norm_tempo,
+t.popularity=event.popularity,
+t.speechiness=event.speechiness,
+t.tempo=event.tempo,
+t.timeSignature=event.time_signature,
+t.valence=event.valence,
+t.genre=event.genreList,
+t.contentHash=event.content_hash
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_trackID FOR (t:Tracks) REQUIRE t.trackID IS UNIQUE;""")\
-    .option("query", cypher_Tracks)\
-    .save()
+run_batched(cypher_Tracks, write_tracks_df)
 print(cypher_Tracks)
 
 #create the Artists node labels
 cypher_Artists='''
+UNWIND $batch AS event
 MERGE (a:Artists{artistID:event.artist_id})
-ON CREATE SET a.artistName=event.artist
+SET a.artistName=event.artist
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_artistID FOR (a:Artists) REQUIRE a.artistID IS UNIQUE;""")\
-    .option("query", cypher_Artists)\
-    .save()
+run_batched(cypher_Artists, write_tracks_df.select('artist_id', 'artist').dropDuplicates(['artist_id']))
 print(cypher_Artists)
 
 #create the Albums node labels
 cypher_Albums='''
+UNWIND $batch AS event
 MERGE (a:Albums{albumID:event.album_id})
-ON CREATE SET a.albumName=event.album, a.artistID=event.artist_id
+SET a.albumName=event.album, a.artistID=event.artist_id
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_albumID FOR (a:Albums) REQUIRE a.albumID IS UNIQUE;""")\
-    .option("query", cypher_Albums)\
-    .save()
+run_batched(cypher_Albums, write_tracks_df.select('album_id', 'album', 'artist_id').dropDuplicates(['album_id']))
 print(cypher_Albums)
 
 #create the Countries node labels
 cypher_Countries='''
+UNWIND $batch AS event
 MERGE (c:Countries{countryCode:event.country_code})
-ON CREATE SET c.country=event.country
+SET c.country=event.country
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_countryCode FOR (c:Countries) REQUIRE c.countryCode IS UNIQUE;""")\
-    .option("query", cypher_Countries)\
-    .save()
+run_batched(cypher_Countries, write_rows_df.select('country_code', 'country').dropDuplicates(['country_code']))
 print(cypher_Countries)
 
 #create a total count of songs for each music genre
+#(the counts are computed in Spark, one row per genre with the number of distinct tracks of that genre, and
+#loaded as ready-made nodes, so running it again sets the same counts instead of adding to them)
+genre_counts_df = tracks_df.select('track_id', explode('genreList').alias('genre')).distinct()\
+    .groupBy('genre').agg(count('*').alias('total_songs'))
+
 cypher_GenreCounts='''
-MATCH (t:Tracks)
-FOREACH (item in t.genre |
-MERGE (g:GenreCounts{genreName:item})
-ON CREATE SET g.totalSongs=1
-ON MATCh SET g.totalSongs=g.totalSongs+1)
+UNWIND $batch AS event
+MERGE (g:GenreCounts{genreName:event.genre})
+SET g.totalSongs=event.total_songs
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("script", """CREATE CONSTRAINT con_genreName FOR (g:GenreCounts) REQUIRE g.genreName IS UNIQUE;""")\
-    .option("query", cypher_GenreCounts)\
-    .save()
+run_batched(cypher_GenreCounts, genre_counts_df)
+run_cypher("MATCH (g:GenreCounts) WHERE NOT g.genreName IN $genres DETACH DELETE g",
+           genres = [r['genre'] for r in genre_counts_df.select('genre').collect()])
 print(cypher_GenreCounts)
 
 ####################now create basic relationships
+#each relationship is built from the distinct (source key, target key) pairs in the data,
+#the two nodes are looked up through their unique constraints and the edge is merged, so
+#the work is linear in the number of edges and re-running doesn't duplicate them
+#(only the edges of the added and changed tracks, playlists and countries are written)
 #artist performs track relationship
 cypher_relationships_PERFORMS='''
-MATCH (t:Tracks),(a:Artists)
-WHERE (t.artistID)=(a.artistID)
-CREATE (a) - [:PERFORMS] -> (t)
+UNWIND $batch AS event
+MATCH (a:Artists{artistID:event.artist_id})
+MATCH (t:Tracks{trackID:event.track_id})
+MERGE (a) - [:PERFORMS] -> (t)
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_PERFORMS)\
-    .save()
+run_batched(cypher_relationships_PERFORMS, write_tracks_df.select('artist_id', 'track_id'))
 print(cypher_relationships_PERFORMS)
 
 #artist creates album relationship
 cypher_relationships_CREATES='''
-MATCH (al:Albums),(a:Artists)
-WHERE (al.artistID)=(a.artistID)
-CREATE (a) - [:CREATES] -> (al)
+UNWIND $batch AS event
+MATCH (a:Artists{artistID:event.artist_id})
+MATCH (al:Albums{albumID:event.album_id})
+MERGE (a) - [:CREATES] -> (al)
 '''
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_CREATES)\
-    .save()
+run_batched(cypher_relationships_CREATES, write_tracks_df.select('album_id', 'artist_id').dropDuplicates(['album_id']))
 print(cypher_relationships_CREATES)
 
 #album contains a track relationship
 cypher_relationships_CONTAINS='''
-MATCH (a:Albums),(t:Tracks)
-WHERE (a.albumID)=(t.albumID)
-CREATE (a) - [:CONTAINS] -> (t)
+UNWIND $batch AS event
+MATCH (a:Albums{albumID:event.album_id})
+MATCH (t:Tracks{trackID:event.track_id})
+MERGE (a) - [:CONTAINS] -> (t)
 '''
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_CONTAINS)\
-    .save()
+run_batched(cypher_relationships_CONTAINS, write_tracks_df.select('album_id', 'track_id'))
 print(cypher_relationships_CONTAINS)
 
 #track added to playlist relationship
 cypher_relationships_ADDED_TO='''
-MATCH (t:Tracks),(p:Playlists)
-WHERE (t.trackID IN p.trackID)
-CREATE (t) - [:ADDED_TO] -> (p)
+UNWIND $batch AS event
+MATCH (t:Tracks{trackID:event.track_id})
+MATCH (p:Playlists{playlistID:event.playlist_id})
+MERGE (t) - [:ADDED_TO] -> (p)
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_ADDED_TO)\
-    .save()
+run_batched(cypher_relationships_ADDED_TO, write_rows_df.select('track_id', 'playlist_id').distinct())
 print(cypher_relationships_ADDED_TO)
 
 #playlist popular in a country relationship
 cypher_relationships_POPULAR_IN='''
-MATCH (p:Playlists),(c:Countries)
-WHERE (p.countryCode)=(c.countryCode)
-CREATE (p) - [:POPULAR_IN] -> (c)
+UNWIND $batch AS event
+MATCH (p:Playlists{playlistID:event.playlist_id})
+MATCH (c:Countries{countryCode:event.country_code})
+MERGE (p) - [:POPULAR_IN] -> (c)
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_POPULAR_IN)\
-    .save()
+run_batched(cypher_relationships_POPULAR_IN, write_rows_df.select('playlist_id', 'country_code').distinct())
 print(cypher_relationships_POPULAR_IN)
 
 #merge a relationship that will be used to show the traits of songs for each country
 cypher_relationships_COUNTRY_TRACKS='''
-MATCH (t:Tracks) - [:ADDED_TO] -> (p:Playlists) - [:POPULAR_IN] -> (c:Countries)
+UNWIND $batch AS event
+MATCH (c:Countries{countryCode:event.country_code})
+MATCH (t:Tracks{trackID:event.track_id})
 MERGE (c) - [:COUNTRY_TRACKS] -> (t)
 '''
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_COUNTRY_TRACKS)\
-    .save()
+run_batched(cypher_relationships_COUNTRY_TRACKS, filter_keys(all_json_df.select('country_code', 'track_id'), 'country_code', affected_countries).distinct())
 print(cypher_relationships_COUNTRY_TRACKS)
 
 #track genre to genre count relationship
 cypher_relationships_IS_TYPE='''
-MATCH (t:Tracks),(g:GenreCounts)
-WHERE (g.genreName IN t.genre)
-CREATE (t) - [:IS_TYPE] -> (g)
+UNWIND $batch AS event
+MATCH (t:Tracks{trackID:event.track_id})
+MATCH (g:GenreCounts{genreName:event.genre})
+MERGE (t) - [:IS_TYPE] -> (g)
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_IS_TYPE)\
-    .save()
+run_batched(cypher_relationships_IS_TYPE, write_tracks_df.select('track_id', explode('genreList').alias('genre')).distinct())
 print(cypher_relationships_IS_TYPE)
 
 #genrecount per country relationship
+#(computed in Spark as the number of distinct tracks of each genre in each country, and stored on the edge as trackCount)
+country_genre_df = filter_keys(all_json_df.select('country_code', 'track_id'), 'country_code', genre_countries).distinct()\
+    .join(tracks_df.select('track_id', explode('genreList').alias('genre')), on='track_id')\
+    .groupBy('country_code', 'genre').agg(count('*').alias('track_count'))
+
 cypher_relationships_COUNTRY_GENRE='''
-MATCH (c:Countries) - [:COUNTRY_TRACKS] -> (t:Tracks) - [:IS_TYPE] -> (g:GenreCounts)
-MERGE (c) - [:COUNTRY_GENRE] -> (g)
+UNWIND $batch AS event
+MATCH (c:Countries{countryCode:event.country_code})
+MATCH (g:GenreCounts{genreName:event.genre})
+MERGE (c) - [r:COUNTRY_GENRE] -> (g)
+SET r.trackCount=event.track_count
 '''
 
-all_json_df.write.format("org.neo4j.spark.DataSource").mode("Overwrite")\
-    .option("url", bolt_url)\
-    .option("query", cypher_relationships_COUNTRY_GENRE)\
-    .save()
+run_batched(cypher_relationships_COUNTRY_GENRE, country_genre_df)
 print(cypher_relationships_COUNTRY_GENRE)
 
+#remove artists, albums and countries that no longer have any tracks or playlists after the removals above
+cypher_remove_orphans=[
+    "MATCH (a:Artists) WHERE NOT (a) - [:PERFORMS] -> () DETACH DELETE a",
+    "MATCH (a:Albums) WHERE NOT (a) - [:CONTAINS] -> () DETACH DELETE a",
+    "MATCH (c:Countries) WHERE NOT () - [:POPULAR_IN] -> (c) DETACH DELETE c"]
+
+for cypher in cypher_remove_orphans:
+    run_cypher(cypher)
+print("orphaned nodes removed")
+
 """***look at data graphs (performed in neo4j)***
 
 ### view bigger playlist picture
@@ -1190,24 +1598,40 @@ country_avgStats=spark.read.format("org.neo4j.spark.DataSource")\
 country_avgStats.toPandas().sort_values(['popularity','energy'],ascending=False)
 
 #now the the differential between a countries song traits averages and the overall collection of songs averages
+#(the overall averages are computed once first and carried into the per-country query, instead of
+#matching every track against every country-track relationship)
 cypher_countryStats_diff='''
 MATCH (s:Tracks)
+WITH avg(s.acousticness) as global_acousticness,
+avg(s.danceability) as global_danceability,
+avg(s.duration) as global_duration,
+avg(s.energy) as global_energy,
+avg(s.instrumentalness) as global_instrumentalness,
+avg(s.key) as global_key,
+avg(s.liveness) as global_liveness,
+avg(s.loudness) as global_loudness,
+avg(s.normTempo) as global_normTempo,
+avg(s.popularity) as global_popularity,
+avg(s.speechiness) as global_speechiness,
+avg(s.tempo) as global_tempo,
+avg(s.timeSignature) as global_timeSignature,
+avg(s.valence) as global_valence
 MATCH (c:Countries) - [r:COUNTRY_TRACKS] -> (t:Tracks)
-RETURN  c.country as countryName, count(distinct(r)) as count,
-avg(t.acousticness)-avg(s.acousticness) as acousticness,
-avg(t.danceability)-avg(s.danceability) as danceability,
-avg(t.duration)-avg(s.duration) as duration,
-avg(t.energy)-avg(s.energy) as energy,
-avg(t.instrumentalness)-avg(s.instrumentalness) as instrumentalness,
-avg(t.key)-avg(s.key) as key,
-avg(t.liveness)-avg(s.liveness) as liveness,
-avg(t.loudness)-avg(s.loudness) as loudness,
-avg(t.normTempo)-avg(s.normTempo) as normTempo,
-avg(t.popularity)-avg(s.popularity) as popularity,
-avg(t.speechiness)-avg(s.speechiness) as speechiness,
-avg(t.tempo)-avg(s.tempo) as tempo,
-avg(t.timeSignature)-avg(s.timeSignature) as timeSignature,
-avg(t.valence)-avg(s.valence) as valence'''
+RETURN  c.country as countryName, count(r) as count,
+avg(t.acousticness)-global_acousticness as acousticness,
+avg(t.danceability)-global_danceability as danceability,
+avg(t.duration)-global_duration as duration,
+avg(t.energy)-global_energy as energy,
+avg(t.instrumentalness)-global_instrumentalness as instrumentalness,
+avg(t.key)-global_key as key,
+avg(t.liveness)-global_liveness as liveness,
+avg(t.loudness)-global_loudness as loudness,
+avg(t.normTempo)-global_normTempo as normTempo,
+avg(t.popularity)-global_popularity as popularity,
+avg(t.speechiness)-global_speechiness as speechiness,
+avg(t.tempo)-global_tempo as tempo,
+avg(t.timeSignature)-global_timeSignature as timeSignature,
+avg(t.valence)-global_valence as valence'''
 
 countryStats_diff=spark.read.format("org.neo4j.spark.DataSource")\
     .option("url",bolt_url)\
@@ -1277,4 +1701,705 @@ country_genreCount=spark.read.format("org.neo4j.spark.DataSource")\
     .option("url",bolt_url)\
     .option("query",cypher_country_genreCount)\
     .load()
-country_genreCount.toPandas().sort_values(['country','totalSongs'],ascending=False)
\ No newline at end of file
+country_genreCount.toPandas().sort_values(['country','totalSongs'],ascending=False)
+################################################################################
+### Offline analytics (no Neo4j needed) ########################################
+################################################################################
+
+###All of the report queries above are plain group-bys over the collected data,
+# so the same tables can be computed straight from the world_top_playlists
+# Parquet dataset with pandas. Each report function returns the same columns as
+# its Cypher query, using the same track rows the graph loader writes, so the
+# reports can be regenerated in seconds without a graph server running.
+
+# The track properties returned by the report queries, in the same order, and the dataset columns that are named differently
+report_features = ['acousticness', 'danceability', 'duration', 'energy', 'instrumentalness', 'key', 'liveness', 'loudness',
+                   'normTempo', 'popularity', 'speechiness', 'tempo', 'timeSignature', 'valence']
+report_renames = {'duration_ms': 'duration', 'norm_tempo': 'normTempo', 'time_signature': 'timeSignature'}
+
+# Function to read the collected dataset for the offline reports
+def load_analysis_dataset(dataset_dir):
+    df = pd.read_parquet(dataset_dir)
+    df['country_code'] = df['country_code'].astype(str)
+    return set_collection_types(df)
+print("load_analysis_dataset function created")
+
+# Function to get one row per track with the properties of its Tracks node. Like the graph loader, each track is
+# taken from the first playlist it appears on (by country code, then playlist id).
+def analysis_tracks(df):
+    tracks = df.sort_values(['country_code', 'playlist_id'], kind='stable').drop_duplicates('track_id')
+    return tracks.rename(columns=report_renames).reset_index(drop=True)
+
+# Function to get the overall average song traits across every track in the dataset, the baseline the
+# country averages are compared against. It only depends on the tracks, so compute it once per dataset.
+def global_baseline(df):
+    return analysis_tracks(df)[report_features].astype('float64').mean()
+
+# Function to get the distinct (country, track) pairs, the equivalent of the COUNTRY_TRACKS relationship
+def analysis_country_tracks(df):
+    return df[['country_code', 'country', 'track_id']].drop_duplicates(['country_code', 'track_id'])
+
+# Function to get the distinct (track, genre) pairs, the equivalent of the IS_TYPE relationship
+def analysis_track_genres(tracks):
+    return tracks[['track_id', 'genre']].explode('genre').dropna(subset=['genre']).drop_duplicates()
+
+#the number of playlists each track appears on, with its audio features (cypher_track_Pcount)
+def report_track_Pcount(df):
+    tracks = analysis_tracks(df)
+    counts = df.groupby('track_id')['playlist_id'].nunique().rename('count')
+    tracks = tracks.join(counts, on='track_id').rename(columns={'track_name': 'trackName', 'track_id': 'trackID'})
+    return tracks[['trackName', 'trackID', 'count'] + report_features]
+
+#the average song traits for each country (cypher_country_avgStats)
+def report_country_avgStats(df):
+    country_tracks = analysis_country_tracks(df).merge(analysis_tracks(df)[['track_id'] + report_features], on='track_id')
+    return country_tracks.groupby('country_code', sort=False)\
+        .agg(countryName=('country', 'first'), count=('track_id', 'size'), **{f: (f, 'mean') for f in report_features})\
+        .reset_index(drop=True)
+
+#how many playlists each artist shows up on (cypher_artist_PLCount, the ARTIST_PLAYLISTS relationship)
+def report_artist_PLCount(df):
+    artist_playlists = df[['track_id', 'playlist_id']].merge(analysis_tracks(df)[['track_id', 'artist_id', 'artist']], on='track_id')
+    return artist_playlists.groupby('artist_id', sort=False)\
+        .agg(artistName=('artist', 'first'), count=('playlist_id', 'nunique'))\
+        .reset_index(drop=True)
+
+#the average song traits and number of tracks for each artist (cypher_artist_avgStats)
+def report_artist_avgStats(df):
+    return analysis_tracks(df).groupby('artist_id', sort=False)\
+        .agg(name=('artist', 'first'), trackCount=('track_id', 'size'), **{f: (f, 'mean') for f in report_features})\
+        .reset_index(drop=True)
+
+#how many songs are of each genre type (cypher_genre_songCount)
+def report_genre_songCount(df):
+    genre_counts = analysis_track_genres(analysis_tracks(df)).groupby('genre').size()
+    return genre_counts.rename('totalSongs').rename_axis('Genre').reset_index()\
+        .sort_values('totalSongs', ascending=False, kind='stable').reset_index(drop=True)
+
+#the genres in each country, with each genre's total song count (cypher_country_genreCount)
+def report_country_genreCount(df):
+    track_genres = analysis_track_genres(analysis_tracks(df))
+    country_genres = analysis_country_tracks(df).merge(track_genres, on='track_id')\
+        .drop_duplicates(['country_code', 'genre'])
+    genre_counts = report_genre_songCount(df).rename(columns={'Genre': 'genre', 'totalSongs': 'TotalSongs'})
+    return country_genres.merge(genre_counts, on='genre')\
+        .rename(columns={'country': 'Country', 'genre': 'Genre'})[['Country', 'Genre', 'TotalSongs']]
+
+#the differential between each country's song trait averages and the overall averages (cypher_countryStats_diff).
+#The baseline from global_baseline can be passed in when it has already been computed for this dataframe.
+def report_countryStats_diff(df, baseline=None):
+    if baseline is None:
+        baseline = global_baseline(df)
+    diff = report_country_avgStats(df)
+    diff[report_features] = diff[report_features].astype('float64') - baseline
+    return diff
+
+from functools import partial
+
+analysis_df = load_analysis_dataset(world_top_playlists_dir)
+#the global baseline only depends on the dataset, so it is computed once here and shared by every report using it
+analysis_baseline = global_baseline(analysis_df)
+
+#every offline report by name, so they can all be regenerated in one loop
+offline_reports = {
+    'track_Pcount': report_track_Pcount,
+    'country_avgStats': report_country_avgStats,
+    'countryStats_diff': partial(report_countryStats_diff, baseline=analysis_baseline),
+    'artist_PLCount': report_artist_PLCount,
+    'artist_avgStats': report_artist_avgStats,
+    'genre_songCount': report_genre_songCount,
+    'country_genreCount': report_country_genreCount
+}
+print("offline reports created")
+
+offline_results = {name: report(analysis_df) for name, report in offline_reports.items()}
+offline_results['track_Pcount'].sort_values('count', ascending=False)
+offline_results['country_avgStats'].sort_values(['popularity','energy'], ascending=False)
+offline_results['countryStats_diff'].sort_values(['popularity','energy'], ascending=False)
+
+################################################################################
+### Materialized feature aggregates ############################################
+################################################################################
+
+###Running totals of the audio features for each country, artist and genre.
+# For every group the tables hold the number of tracks and, for each feature in
+# feature_list, the number of values, their sum and their sum of squares, so
+# means and variances can be read in O(groups) without going back to the tracks.
+# The artist table also holds the number of playlists each artist is on, and the
+# track table the number of playlists each track is on.
+# Each collection partition (one per country_code) keeps its own country totals
+# and a table with one row per track. When new or re-collected partitions arrive
+# only those partitions are read: their tracks are added and the tracks of
+# removed or replaced partitions are taken back out. Like the reports, a track is
+# counted once for its artist and genres however many countries it charts in, so
+# the track table keeps the number of partitions containing each track as a
+# reference count, and a track's features are only added to (or subtracted from)
+# the artist and genre totals when its count goes from 0 to 1 (or 1 to 0). The
+# (track, playlist) and (artist, playlist) pairs are reference counted the same
+# way for the playlist counts. A track's artist, genres and audio features are the
+# same on every playlist, so they are taken from the first partition it arrives in.
+aggregate_keys = {'country': ['country_code', 'country'], 'artist': ['artist_id', 'artist'], 'genre': ['genre']}
+aggregate_value_columns = ['count'] + [f'{f}_{part}' for f in feature_list for part in ['n', 'sum', 'sumsq']]
+track_property_columns = ['track_id', 'artist_id', 'artist', 'genre'] + feature_list
+
+# Function to total up the features of df (one row per track in each group) by the key columns
+def feature_totals(df, keys):
+    groups = [df[k] for k in keys]
+    values = {'count': df.groupby(groups).size()}
+    for f in feature_list:
+        x = df[f].astype('float64')
+        values[f'{f}_n'] = x.notna().groupby(groups).sum()
+        values[f'{f}_sum'] = x.groupby(groups).sum()
+        values[f'{f}_sumsq'] = (x * x).groupby(groups).sum()
+    return pd.DataFrame(values, columns=aggregate_value_columns).rename_axis(keys).reset_index()
+
+# Function to get one row per track of a collection partition, with the track's properties taken from its
+# first playlist and the list of the partition's playlists it is on
+def partition_tracks(part_df):
+    df = part_df.sort_values('playlist_id', kind='stable')
+    playlists = df.groupby('track_id')['playlist_id'].unique().map(list).rename('playlists')
+    tracks = df.drop_duplicates('track_id')[['country_code', 'playlist_id', 'track_id', 'artist_id', 'artist', 'genre'] + feature_list]
+    return tracks.rename(columns={'playlist_id': 'first_playlist_id'}).join(playlists, on='track_id').reset_index(drop=True)
+
+# Function to apply reference count changes to a table of keys and their 'refs'. deltas has the key columns and
+# a 'delta' column. Returns the updated table, the keys whose count went from 0 to above 0 and the keys whose
+# count went back to 0.
+def apply_ref_deltas(refs, deltas, keys):
+    deltas = deltas.dropna(subset=keys).groupby(keys, as_index=False)['delta'].sum()
+    merged = refs.merge(deltas, on=keys, how='outer')
+    old = merged['refs'].fillna(0).astype('int64')
+    new = old + merged['delta'].fillna(0).astype('int64')
+    merged['refs'] = new
+    return merged.loc[new > 0, keys + ['refs']].reset_index(drop=True), \
+        merged.loc[(old == 0) & (new > 0), keys], merged.loc[(old > 0) & (new <= 0), keys]
+
+# Function to add signed contributions to a totals table, groups whose track count drops to 0 are removed
+def add_totals(totals, deltas, keys, columns):
+    combined = pd.concat([totals] + deltas, ignore_index=True)
+    if len(combined) == 0:
+        return totals
+    combined = combined.groupby(keys, as_index=False)[columns].sum()
+    return combined[combined['count'] > 0].reset_index(drop=True)
+
+# Function to take the signed contribution of a set of tracks to the totals of one aggregate table
+def signed_totals(tracks, keys, sign):
+    totals = feature_totals(tracks, keys)
+    totals[aggregate_value_columns] = totals[aggregate_value_columns] * sign
+    return totals
+
+# Function to read one of the aggregate tables, or an empty table with the given columns if it doesn't exist yet
+def read_aggregate_table(path, columns):
+    return pd.read_parquet(path) if os.path.exists(path) else pd.DataFrame(columns=columns)
+
+# Function to update the track, artist and genre tables with the tracks of added and removed partitions
+# (lists of partition_tracks tables)
+def update_track_aggregates(agg_dir, added_parts, removed_parts):
+    track_totals = read_aggregate_table(f'{agg_dir}/track_totals.parquet',
+                                        track_property_columns + ['partitions', 'playlist_count'])
+    track_playlists = read_aggregate_table(f'{agg_dir}/track_playlists.parquet', ['track_id', 'playlist_id', 'refs'])
+    artist_playlists = read_aggregate_table(f'{agg_dir}/artist_playlists.parquet', ['artist_id', 'playlist_id', 'refs'])
+    artist_totals = read_aggregate_table(f'{agg_dir}/artist_totals.parquet',
+                                         aggregate_keys['artist'] + aggregate_value_columns + ['playlist_count'])
+    genre_totals = read_aggregate_table(f'{agg_dir}/genre_totals.parquet', aggregate_keys['genre'] + aggregate_value_columns)
+    added = pd.concat(added_parts, ignore_index=True) if added_parts else pd.DataFrame(columns=['country_code', 'first_playlist_id'] + track_property_columns + ['playlists'])
+    removed = pd.concat(removed_parts, ignore_index=True) if removed_parts else pd.DataFrame(columns=['country_code', 'first_playlist_id'] + track_property_columns + ['playlists'])
+
+    # the properties of every track that is or was counted, new tracks take theirs from the first partition (by country code)
+    added_props = added.sort_values(['country_code', 'first_playlist_id'], kind='stable').drop_duplicates('track_id')
+    props = pd.concat([track_totals[track_property_columns],
+                       added_props.loc[~added_props['track_id'].isin(track_totals['track_id']), track_property_columns]],
+                      ignore_index=True).set_index('track_id', drop=False)
+
+    # tracks: one reference per partition containing the track
+    track_refs, appeared, disappeared = apply_ref_deltas(
+        track_totals[['track_id', 'partitions']].rename(columns={'partitions': 'refs'}),
+        pd.concat([added[['track_id']].assign(delta=1), removed[['track_id']].assign(delta=-1)], ignore_index=True), ['track_id'])
+    appeared_tracks = props.loc[appeared['track_id']].reset_index(drop=True)
+    disappeared_tracks = props.loc[disappeared['track_id']].reset_index(drop=True)
+
+    artist_totals = add_totals(artist_totals, [signed_totals(appeared_tracks, aggregate_keys['artist'], 1),
+                                               signed_totals(disappeared_tracks, aggregate_keys['artist'], -1)],
+                               aggregate_keys['artist'], aggregate_value_columns + ['playlist_count'])
+    genre_totals = add_totals(genre_totals, [signed_totals(analysis_track_genres(appeared_tracks).merge(appeared_tracks[['track_id'] + feature_list], on='track_id'), aggregate_keys['genre'], 1),
+                                             signed_totals(analysis_track_genres(disappeared_tracks).merge(disappeared_tracks[['track_id'] + feature_list], on='track_id'), aggregate_keys['genre'], -1)],
+                              aggregate_keys['genre'], aggregate_value_columns)
+
+    # (track, playlist) pairs: one reference per partition with the track on that playlist
+    def pair_deltas(parts, sign):
+        return parts[['track_id', 'playlists']].explode('playlists').dropna()\
+            .rename(columns={'playlists': 'playlist_id'}).assign(delta=sign)
+    track_playlists, new_pairs, gone_pairs = apply_ref_deltas(
+        track_playlists, pd.concat([pair_deltas(added, 1), pair_deltas(removed, -1)], ignore_index=True), ['track_id', 'playlist_id'])
+    track_playlist_delta = new_pairs.groupby('track_id').size().sub(gone_pairs.groupby('track_id').size(), fill_value=0)
+
+    # (artist, playlist) pairs: one reference per track of the artist on that playlist
+    artist_of = props['artist_id']
+    artist_playlists, new_artist_pairs, gone_artist_pairs = apply_ref_deltas(
+        artist_playlists, pd.concat([new_pairs.assign(artist_id=artist_of.reindex(new_pairs['track_id']).to_numpy(), delta=1),
+                                     gone_pairs.assign(artist_id=artist_of.reindex(gone_pairs['track_id']).to_numpy(), delta=-1)],
+                                    ignore_index=True)[['artist_id', 'playlist_id', 'delta']], ['artist_id', 'playlist_id'])
+    artist_playlist_delta = new_artist_pairs.groupby('artist_id').size().sub(gone_artist_pairs.groupby('artist_id').size(), fill_value=0)
+    artist_totals['playlist_count'] = (artist_totals['playlist_count'].fillna(0)
+                                       + artist_totals['artist_id'].map(artist_playlist_delta).fillna(0)).astype('int64')
+
+    old_playlist_counts = track_totals.set_index('track_id')['playlist_count']
+    track_totals = props.loc[track_refs['track_id']].reset_index(drop=True)
+    track_totals['partitions'] = track_refs['refs'].to_numpy()
+    track_totals['playlist_count'] = (track_totals['track_id'].map(old_playlist_counts).fillna(0)
+                                      + track_totals['track_id'].map(track_playlist_delta).fillna(0)).astype('int64')
+
+    write_parquet_atomic(track_totals, f'{agg_dir}/track_totals.parquet')
+    write_parquet_atomic(track_playlists, f'{agg_dir}/track_playlists.parquet')
+    write_parquet_atomic(artist_playlists, f'{agg_dir}/artist_playlists.parquet')
+    write_parquet_atomic(artist_totals, f'{agg_dir}/artist_totals.parquet')
+    write_parquet_atomic(genre_totals, f'{agg_dir}/genre_totals.parquet')
+
+def write_parquet_atomic(df, path):
+    write_atomic(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+
+# Function to bring the aggregate tables up to date with the partitions in the collection's manifest
+def refresh_feature_aggregates(dataset_dir, agg_dir):
+    state_path = f'{agg_dir}/_state.json'
+    state = read_json(state_path, {'partitions': {}})
+
+    # a partition is identified by its file and the time it was collected, so re-collected partitions are picked up
+    manifest = read_manifest(dataset_dir)
+    current = {c: f"{entry['file']}@{entry['finished']}" for c, entry in manifest['countries'].items()
+               if entry.get('status') == 'done' and entry.get('file')}
+    new = [c for c in current if state['partitions'].get(c) != current[c]]
+    gone = [c for c in state['partitions'] if c not in current]
+    # removed and re-collected partitions have their old tracks taken back out
+    old = gone + [c for c in new if c in state['partitions']]
+
+    # without the previous tables (a first run, or files that went missing) everything is rebuilt from the partitions
+    if not all(os.path.exists(f'{agg_dir}/{table}.parquet') for table in
+               ['track_totals', 'track_playlists', 'artist_playlists', 'artist_totals', 'genre_totals']) \
+            or not all(os.path.exists(f'{agg_dir}/tracks/country_code={c}.parquet') for c in old):
+        print("Feature aggregates: rebuilding every table")
+        for table in ['track_totals', 'track_playlists', 'artist_playlists', 'artist_totals', 'genre_totals', 'country_totals']:
+            if os.path.exists(f'{agg_dir}/{table}.parquet'):
+                os.remove(f'{agg_dir}/{table}.parquet')
+        new, old = list(current), []
+    print(f"Feature aggregates: {len(new)} new or updated partitions, {len(gone)} removed, {len(current) - len(new)} unchanged")
+
+    for part in ['country', 'tracks']:
+        os.makedirs(f'{agg_dir}/{part}', exist_ok=True)
+    removed_parts = [pd.read_parquet(f'{agg_dir}/tracks/country_code={c}.parquet') for c in old]
+    for c in gone:
+        for part in ['country', 'tracks']:
+            if os.path.exists(f'{agg_dir}/{part}/country_code={c}.parquet'):
+                os.remove(f'{agg_dir}/{part}/country_code={c}.parquet')
+
+    added_parts = []
+    for c in new:
+        part_df = pd.read_parquet(f"{dataset_dir}/{manifest['countries'][c]['file']}")
+        part_df['country_code'] = c
+        write_parquet_atomic(feature_totals(part_df.drop_duplicates('track_id'), aggregate_keys['country']),
+                             f'{agg_dir}/country/country_code={c}.parquet')
+        added_parts.append(partition_tracks(part_df))
+        write_parquet_atomic(added_parts[-1], f'{agg_dir}/tracks/country_code={c}.parquet')
+
+    if new or gone or not os.path.exists(f'{agg_dir}/country_totals.parquet'):
+        # there is one small table per country, so the country totals are simply their concatenation
+        country_parts = [pd.read_parquet(f'{agg_dir}/country/country_code={c}.parquet') for c in current]
+        country_totals = pd.concat(country_parts, ignore_index=True) if country_parts else \
+            pd.DataFrame(columns=aggregate_keys['country'] + aggregate_value_columns)
+        write_parquet_atomic(country_totals, f'{agg_dir}/country_totals.parquet')
+        update_track_aggregates(agg_dir, added_parts, removed_parts)
+
+    state['partitions'] = current
+    write_json_atomic(state_path, state)
+print("refresh_feature_aggregates function created")
+
+# Function to read the mean and variance of every feature for each group of one aggregate table ('country', 'artist' or 'genre')
+def read_feature_aggregates(agg_dir, kind):
+    totals = pd.read_parquet(f'{agg_dir}/{kind}_totals.parquet')
+    stats = totals[aggregate_keys[kind] + ['count'] + (['playlist_count'] if kind == 'artist' else [])].copy()
+    for f in feature_list:
+        n = totals[f'{f}_n'].where(totals[f'{f}_n'] > 0)
+        mean = totals[f'{f}_sum'] / n
+        stats[f'{f}_mean'] = mean
+        stats[f'{f}_var'] = (totals[f'{f}_sumsq'] / n - mean * mean).clip(lower=0)
+    return stats
+print("read_feature_aggregates function created")
+
+# Function to read the number of playlists each track is on (and the number of collection partitions containing it)
+def read_track_playlist_counts(agg_dir):
+    return pd.read_parquet(f'{agg_dir}/track_totals.parquet', columns=['track_id', 'partitions', 'playlist_count'])
+
+feature_aggregates_dir = f'{default_directory}/datafiles/feature_aggregates'
+refresh_feature_aggregates(world_top_playlists_dir, feature_aggregates_dir)
+country_feature_stats = read_feature_aggregates(feature_aggregates_dir, 'country')
+country_feature_stats.sort_values('energy_mean', ascending=False)
+
+################################################################################
+### Track similarity index #####################################################
+################################################################################
+
+###Finds the most similar tracks (or countries) by their audio features.
+# Each feature in feature_list is standardized (mean 0, standard deviation 1) so
+# that tempo and duration don't outweigh the 0-1 features, and the tracks are
+# stored as one float32 NumPy matrix. Queries use a KD-tree when scipy is
+# installed (%pip install scipy) and otherwise an exact blocked NumPy search,
+# both return the exact nearest neighbours by Euclidean distance. The index can
+# be saved as .npy files and loaded back memory-mapped.
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+class TrackSimilarityIndex:
+    def __init__(self, track_ids, track_names, matrix, mean, std, country_codes, country_matrix):
+        self.track_ids = track_ids
+        self.track_names = track_names
+        self.matrix = matrix
+        self.mean = mean
+        self.std = std
+        self.country_codes = country_codes
+        self.country_matrix = country_matrix
+        self.country_positions = {code: i for i, code in enumerate(country_codes)}
+        # the track lookup and the KD-tree read the whole index, so they are only built the first time they're needed
+        self.track_positions = None
+        self.tree = None
+
+    def position(self, track_id):
+        if self.track_positions is None:
+            self.track_positions = {idd: i for i, idd in enumerate(self.track_ids)}
+        return self.track_positions[track_id]
+
+    def country_position(self, country_code):
+        try:
+            return self.country_positions[country_code]
+        except KeyError:
+            raise KeyError(f"Unknown country code '{country_code}'") from None
+
+    # Build the index from the collected dataset (the same one-row-per-track table the reports use)
+    @classmethod
+    def build(cls, df):
+        tracks = analysis_tracks(df)
+        features = tracks[[report_renames.get(f, f) for f in feature_list]].astype('float64').to_numpy()
+        mean = np.nanmean(features, axis=0)
+        std = np.nanstd(features, axis=0)
+        std[std == 0] = 1
+        # missing values become the feature's mean, which is 0 after standardizing
+        matrix = np.nan_to_num((features - mean) / std).astype(np.float32)
+
+        # each country's vector is the average of the standardized vectors of its tracks
+        positions = pd.Series(np.arange(len(tracks)), index=tracks['track_id'].to_numpy())
+        country_tracks = df[['country_code', 'track_id']].drop_duplicates()
+        rows = positions[country_tracks['track_id']].to_numpy()
+        codes, country_index = np.unique(country_tracks['country_code'].astype(str).to_numpy(), return_inverse=True)
+        sums = np.zeros((len(codes), matrix.shape[1]), dtype=np.float64)
+        np.add.at(sums, country_index, matrix[rows])
+        country_matrix = (sums / np.bincount(country_index)[:, None]).astype(np.float32)
+
+        return cls(tracks['track_id'].to_numpy().astype(str), tracks['track_name'].to_numpy().astype(str),
+                   matrix, mean, std, codes.astype(str), country_matrix)
+
+    # The k nearest rows of `matrix` for every row of `vectors`, in blocks to keep memory use bounded
+    @staticmethod
+    def nearest(matrix, vectors, k, block_size=1024):
+        k = min(k, len(matrix))
+        norms = (matrix.astype(np.float64) ** 2).sum(axis=1)
+        all_idx = np.empty((len(vectors), k), dtype=np.int64)
+        all_dist = np.empty((len(vectors), k), dtype=np.float64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size].astype(np.float64)
+            d2 = norms[None, :] - 2 * block @ matrix.T.astype(np.float64) + (block ** 2).sum(axis=1)[:, None]
+            idx = np.argpartition(d2, k - 1, axis=1)[:, :k]
+            part = np.take_along_axis(d2, idx, axis=1)
+            order = np.argsort(part, axis=1)
+            all_idx[start:start + block_size] = np.take_along_axis(idx, order, axis=1)
+            all_dist[start:start + block_size] = np.sqrt(np.maximum(np.take_along_axis(part, order, axis=1), 0))
+        return all_dist, all_idx
+
+    def query_vectors(self, vectors, k=10):
+        vectors = np.atleast_2d(vectors)
+        if self.tree is None and cKDTree is not None and len(self.matrix):
+            self.tree = cKDTree(self.matrix)
+        if self.tree is not None:
+            dist, idx = self.tree.query(vectors, k=min(k, len(self.matrix)))
+            return np.atleast_2d(dist).reshape(len(vectors), -1), np.atleast_2d(idx).reshape(len(vectors), -1)
+        return self.nearest(self.matrix, vectors, k)
+
+    # The k tracks most similar to a track, not counting the track itself
+    def similar_tracks(self, track_id, k=10):
+        position = self.position(track_id)
+        dist, idx = self.query_vectors(self.matrix[position], k + 1)
+        keep = idx[0] != position
+        return pd.DataFrame({'trackID': self.track_ids[idx[0][keep]][:k], 'trackName': self.track_names[idx[0][keep]][:k],
+                             'distance': dist[0][keep][:k]})
+
+    # The k most similar tracks for every track at once, returned like query_vectors as (distances, neighbour positions)
+    # arrays with one row per track
+    def similar_tracks_all(self, k=10):
+        dist, idx = self.query_vectors(self.matrix, k + 1)
+        # drop each track's own match, keeping the k closest other tracks
+        not_self = idx != np.arange(len(self.matrix))[:, None]
+        order = np.argsort(~not_self, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(dist, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+    # The k countries whose average track is most similar to the given country's
+    def similar_countries(self, country_code, k=10):
+        position = self.country_position(country_code)
+        dist, idx = self.nearest(self.country_matrix, self.country_matrix[position:position + 1], k + 1)
+        keep = idx[0] != position
+        return pd.DataFrame({'countryCode': self.country_codes[idx[0][keep]][:k], 'distance': dist[0][keep][:k]})
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ['track_ids', 'track_names', 'matrix', 'mean', 'std', 'country_codes', 'country_matrix']:
+            np.save(f'{index_dir}/{name}.npy', getattr(self, name))
+
+    # Load a saved index, the arrays are memory-mapped so only the parts that are used get read from disk
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        arrays = {name: np.load(f'{index_dir}/{name}.npy', mmap_mode='r' if mmap else None)
+                  for name in ['track_ids', 'track_names', 'matrix', 'mean', 'std', 'country_codes', 'country_matrix']}
+        return cls(**arrays)
+print("TrackSimilarityIndex created")
+
+similarity_index = TrackSimilarityIndex.build(analysis_df)
+similarity_index.save(f'{default_directory}/datafiles/similarity_index')
+#the songs that sound the most like "C'est bon"
+similarity_index.similar_tracks(analysis_df.loc[analysis_df['track_name'] == "C'est bon", 'track_id'].iloc[0])
+
+################################################################################
+### Track overlap index ########################################################
+################################################################################
+
+###Answers "which countries (or playlists) share the most songs" without graph traversals.
+# Every track ID gets a dense integer, and each country or playlist is stored as a
+# row of NumPy packed bits (one bit per track), so 181 countries x 10,000 tracks
+# is about 230 KB. Shared counts are the popcount of the AND of two rows, and
+# all pairs are computed in blocks of rows at a time.
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(words):
+        return popcount_table[words.view(np.uint8)].reshape(words.shape + (-1,)).sum(axis=-1, dtype=np.uint8)
+
+class TrackOverlapIndex:
+    def __init__(self, keys, track_ids, bits):
+        self.keys = keys
+        self.track_ids = track_ids
+        self.bits = bits
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.sizes = popcount(bits).sum(axis=1, dtype=np.int64)
+
+    # Build one bitmap per value of `by` ('country_code' or 'playlist_id') from the collected dataset
+    @classmethod
+    def build(cls, df, by='country_code'):
+        pairs = df[[by, 'track_id']].drop_duplicates()
+        keys, rows = np.unique(pairs[by].astype(str).to_numpy(), return_inverse=True)
+        track_ids, columns = np.unique(pairs['track_id'].astype(str).to_numpy(), return_inverse=True)
+        # pad the width to whole 64-bit words
+        width = -(-max(len(track_ids), 1) // 64) * 64
+        dense = np.zeros((len(keys), width), dtype=bool)
+        dense[rows, columns] = True
+        bits = np.packbits(dense, axis=1).view(np.uint64)
+        return cls(keys, track_ids, bits)
+
+    def positions_of(self, keys):
+        return np.array([self.positions[key] for key in keys], dtype=np.int64)
+
+    def shared_count(self, a, b):
+        return int(popcount(self.bits[self.positions[a]] & self.bits[self.positions[b]]).sum())
+
+    def jaccard(self, a, b):
+        shared = self.shared_count(a, b)
+        union = self.sizes[self.positions[a]] + self.sizes[self.positions[b]] - shared
+        return shared / union if union else 0.0
+
+    # The tracks in `key` that no other country (or playlist) has
+    def unique_tracks(self, key):
+        row = self.positions[key]
+        others = np.bitwise_or.reduce(np.delete(self.bits, row, axis=0), axis=0) if len(self.keys) > 1 \
+            else np.zeros_like(self.bits[row])
+        unique = np.unpackbits((self.bits[row] & ~others).view(np.uint8))[:len(self.track_ids)]
+        return self.track_ids[unique.astype(bool)]
+
+    # keys x keys matrix of shared track counts
+    def all_pairs_shared(self, block_size=32):
+        shared = np.empty((len(self.keys), len(self.keys)), dtype=np.int32)
+        for start in range(0, len(self.keys), block_size):
+            block = self.bits[start:start + block_size]
+            shared[start:start + block_size] = popcount(block[:, None, :] & self.bits[None, :, :]).sum(axis=2, dtype=np.int32)
+        return shared
+
+    def all_pairs_jaccard(self):
+        shared = self.all_pairs_shared().astype(np.float64)
+        union = self.sizes[:, None] + self.sizes[None, :] - shared
+        return np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+
+    # The pairs sharing the most tracks, as a DataFrame like the report queries return
+    def top_pairs(self, n=10):
+        shared = self.all_pairs_shared()
+        first, second = np.triu_indices(len(self.keys), k=1)
+        counts = shared[first, second]
+        order = np.argsort(-counts, kind='stable')[:n]
+        return pd.DataFrame({'first': self.keys[first[order]], 'second': self.keys[second[order]],
+                             'sharedTracks': counts[order]})
+print("TrackOverlapIndex created")
+
+country_overlap = TrackOverlapIndex.build(analysis_df, 'country_code')
+playlist_overlap = TrackOverlapIndex.build(analysis_df, 'playlist_id')
+#the countries that share the most top songs
+country_overlap.top_pairs(20)
+
+################################################################################
+### Country by country similarity matrix #######################################
+################################################################################
+
+###Compares every pair of countries at once with NumPy matrix products:
+# - feature: cosine distance between the countries' average (standardized) audio feature vectors
+# - tracks: Jaccard distance between the sets of tracks on their playlists (the COUNTRY_TRACKS relationship)
+# - genre: Hellinger distance between their genre distributions (share of tracks of each genre)
+# The three matrices are saved together as one float32 .npy file, with the country codes in a second file,
+# and can be passed straight to sns.heatmap.
+country_similarity_measures = ['feature', 'tracks', 'genre']
+
+def build_country_similarity(df, index=None, overlap=None):
+    if index is None:
+        index = TrackSimilarityIndex.build(df)
+    if overlap is None:
+        overlap = TrackOverlapIndex.build(df, 'country_code')
+    codes = np.asarray(index.country_codes)
+    country_position = pd.Series(np.arange(len(codes)), index=codes)
+
+    # cosine distance between the average feature vectors
+    vectors = np.asarray(index.country_matrix, dtype=np.float64)
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    feature_distance = np.clip(1 - unit @ unit.T, 0, 2)
+
+    # Jaccard distance between track sets, from the country track bitmaps
+    tracks_distance = 1 - overlap.all_pairs_jaccard()[np.ix_(overlap.positions_of(codes), overlap.positions_of(codes))]
+    country_tracks = df[['country_code', 'track_id']].drop_duplicates()
+
+    # Hellinger distance between genre distributions, from a countries x genres count matrix
+    country_genres = country_tracks.merge(analysis_track_genres(analysis_tracks(df)), on='track_id')
+    genre_codes, genre_index = np.unique(country_genres['genre'].astype(str).to_numpy(), return_inverse=True)
+    genre_counts = np.zeros((len(codes), len(genre_codes)), dtype=np.float64)
+    np.add.at(genre_counts, (country_position[country_genres['country_code'].astype(str)].to_numpy(), genre_index), 1)
+    shares = genre_counts / np.maximum(genre_counts.sum(axis=1, keepdims=True), 1)
+    root = np.sqrt(shares)
+    genre_distance = np.sqrt(np.clip(1 - root @ root.T, 0, 1))
+
+    distances = np.stack([feature_distance, tracks_distance, genre_distance]).astype(np.float32)
+    return codes, distances
+print("build_country_similarity function created")
+
+def save_country_similarity(codes, distances, path_prefix):
+    np.save(f'{path_prefix}.npy', distances)
+    np.save(f'{path_prefix}_codes.npy', codes.astype(str))
+
+# Returns the country codes and a dict of measure name -> countries x countries distance matrix
+def load_country_similarity(path_prefix, mmap=True):
+    distances = np.load(f'{path_prefix}.npy', mmap_mode='r' if mmap else None)
+    codes = np.load(f'{path_prefix}_codes.npy')
+    return codes, dict(zip(country_similarity_measures, distances))
+print("country similarity save/load functions created")
+
+country_codes_sorted, country_distances = build_country_similarity(analysis_df, similarity_index, country_overlap)
+save_country_similarity(country_codes_sorted, country_distances, f'{default_directory}/datafiles/country_similarity')
+
+for i, measure in enumerate(country_similarity_measures):
+    plt.figure(figsize=(30, 25))
+    sns.heatmap(pd.DataFrame(country_distances[i], index=country_codes_sorted, columns=country_codes_sorted))
+    plt.savefig(f'images/country_{measure}_distance_heatmap.jpg')
+
+################################################################################
+### Compact in-memory collection ###############################################
+################################################################################
+
+###Holds the whole collected dataset in a fraction of the memory of the pandas dataframe.
+# The partitions are read with pyarrow and every string column is dictionary encoded,
+# so the ~thousands of artists and the 181 country names are stored once and each
+# row only keeps small integer codes (pandas categoricals). IDs are integer coded
+# the same way, the audio features are float32, and the genre lists are one array
+# of genre codes plus an offsets array (row i's genres are
+# genres[genre_codes[genre_offsets[i]:genre_offsets[i + 1]]]) instead of a Python list per row.
+compact_string_columns = ['artist', 'artist_id', 'album', 'album_id', 'track_name', 'track_id',
+                          'playlist_id', 'top_playlist_name', 'country_code', 'country']
+
+class CompactCollection:
+    def __init__(self, columns, genre_offsets, genre_codes, genres):
+        self.columns = columns
+        self.genre_offsets = genre_offsets
+        self.genre_codes = genre_codes
+        self.genres = genres
+
+    # Load the finished partitions listed in the collection's manifest
+    @classmethod
+    def load(cls, dataset_dir):
+        tables = []
+        for c, entry in sorted(read_manifest(dataset_dir)['countries'].items()):
+            if entry.get('status') == 'done' and entry.get('file'):
+                table = pq.read_table(f"{dataset_dir}/{entry['file']}")
+                tables.append(table.append_column('country_code', pa.array([c] * table.num_rows, pa.string())))
+        if len(tables) == 0:
+            return None
+        table = pa.concat_tables(tables)
+
+        columns = {}
+        for c in compact_string_columns:
+            encoded = table.column(c).combine_chunks().dictionary_encode()
+            columns[c] = pd.Categorical.from_codes(encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False),
+                                                   encoded.dictionary.to_numpy(zero_copy_only=False))
+        for f in feature_list + ['norm_tempo']:
+            columns[f] = table.column(f).to_numpy().astype(np.float32)
+        columns['popularity'] = pd.array(table.column('popularity').to_pandas(), dtype='Int8')
+        columns['explicit'] = pd.array(table.column('explicit').to_pandas(), dtype='boolean')
+
+        genre = table.column('genre').combine_chunks()
+        lengths = pc.fill_null(pc.list_value_length(genre), 0).to_numpy()
+        genre_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        encoded = pc.list_flatten(genre).dictionary_encode()
+        return cls(pd.DataFrame(columns), genre_offsets, encoded.indices.to_numpy().astype(np.int32),
+                   encoded.dictionary.to_numpy(zero_copy_only=False).astype(str))
+
+    def __len__(self):
+        return len(self.columns)
+
+    # Integer codes of an ID or string column, for joins and groupings without the strings
+    def codes(self, column):
+        return self.columns[column].cat.codes.to_numpy()
+
+    # The distinct (track_id, genre) pairs, built from the offsets without any per-row lists
+    def track_genres(self):
+        rows = np.repeat(np.arange(len(self)), np.diff(self.genre_offsets))
+        pairs = pd.DataFrame({'track_id': self.columns['track_id'].to_numpy()[rows],
+                              'genre': pd.Categorical.from_codes(self.genre_codes, self.genres)})
+        return pairs.drop_duplicates().reset_index(drop=True)
+
+    # Expand rows (all of them by default) back into the regular collection dataframe
+    def to_pandas(self, rows=None):
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        df = self.columns.iloc[rows].copy()
+        for c in compact_string_columns:
+            df[c] = df[c].astype(object).where(df[c].notna(), None)
+        starts, ends = self.genre_offsets[rows], self.genre_offsets[rows + 1]
+        df['genre'] = [self.genres[self.genre_codes[a:b]].tolist() for a, b in zip(starts, ends)]
+        return set_collection_types(df.reset_index(drop=True))
+
+    # Write the rows back out as a partitioned collection dataset with a manifest, one country at a time
+    def save(self, dataset_dir):
+        os.makedirs(dataset_dir, exist_ok=True)
+        manifest = read_manifest(dataset_dir)
+        for country_code, rows in self.columns.groupby('country_code', observed=True).indices.items():
+            country_df = self.to_pandas(rows)
+            partition_file = write_collection_partition(country_df, dataset_dir, country_code)
+            manifest['countries'][country_code] = manifest_entry(country_df, partition_file)
+        write_manifest(dataset_dir, manifest)
+
+    def memory_usage(self):
+        return int(self.columns.memory_usage(deep=True).sum() + self.genre_offsets.nbytes + self.genre_codes.nbytes
+                   + sum(len(g) for g in self.genres))
+print("CompactCollection created")
+
+compact_collection = CompactCollection.load(world_top_playlists_dir)
+print(f"compact collection: {compact_collection.memory_usage() / 2**20:.1f} MB, "
+      f"pandas dataframe: {analysis_df.memory_usage(deep=True).sum() / 2**20:.1f} MB")
+#the average energy of each country's top songs, straight from the compact columns
+compact_collection.columns.groupby('country', observed=True)['energy'].mean().sort_values(ascending=False)